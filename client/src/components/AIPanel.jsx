@@ -57,7 +57,30 @@ const ContentRenderer = ({ blocks }) => {
         )
 
       case 'table_group':
-        return renderStreamingTable(block.tableBlocks)
+        // Server-grouped tables arrive with their rows; legacy ones as per-row blocks
+        return block.rows
+          ? renderTable(metadata?.headers || [], block.rows)
+          : renderStreamingTable(block.tableBlocks)
+
+      case 'list_group':
+        return (
+          <div className="mb-2">
+            {(block.items || []).map((item, index) => (
+              <div key={index} className={`flex mb-2 ${item.number === undefined ? 'ml-4' : ''}`}>
+                {item.number === undefined ? (
+                  <span className="text-gray-600 mr-3 mt-1">•</span>
+                ) : (
+                  <span className="text-blue-600 font-semibold mr-3 mt-0.5 min-w-[1.5rem]">
+                    {item.number}.
+                  </span>
+                )}
+                <div className="flex-1">
+                  <FormattedText content={item.content} />
+                </div>
+              </div>
+            ))}
+          </div>
+        )
 
       case 'numbered_list_item':
         const numberMatch = content.match(/^(\d+)\.\s*(.*)/)
@@ -169,8 +192,13 @@ const ContentRenderer = ({ blocks }) => {
       }
     }
 
+    return renderTable(headers, rows)
+  }
+
+  const renderTable = (headers, rows) => {
     // If no headers found, use the first row as headers
-    const finalHeaders = headers.length > 0 ? headers : (rows.length > 0 ? rows.shift() : [])
+    const finalHeaders = headers.length > 0 ? headers : (rows.length > 0 ? rows[0] : [])
+    const bodyRows = headers.length > 0 ? rows : rows.slice(1)
     
     if (finalHeaders.length === 0) return null
 
@@ -190,7 +218,7 @@ const ContentRenderer = ({ blocks }) => {
             </tr>
           </thead>
           <tbody className="bg-white divide-y divide-gray-200">
-            {rows.map((row, rowIndex) => (
+            {bodyRows.map((row, rowIndex) => (
               <tr key={rowIndex} className="hover:bg-gray-50">
                 {row.map((cell, cellIndex) => (
                   <td 
@@ -236,6 +264,68 @@ const FormattedText = ({ content }) => {
   )
 }
 
+const createBlockState = () => ({ blocks: [], current: null, content: '', partial: '' })
+
+// Fold one parsed stream event into the accumulated blocks
+const applyBlockEvent = (state, data) => {
+  if (data.type === 'block_start') {
+    state.current = {
+      type: data.block_info.type,
+      block_id: data.block_info.block_id,
+      content: '',
+      metadata: data.block_info.metadata,
+      context: {}
+    }
+  } else if (data.type === 'content_delta') {
+    // Text of a line still being generated; the line's content event replaces it
+    if (state.current) state.current.content += data.content
+    state.content += data.content
+    state.partial += data.content
+  } else if (data.type === 'content') {
+    if (data.streamed && state.partial) {
+      const dropPartial = (text) => text.slice(0, text.length - state.partial.length)
+      if (state.current) state.current.content = dropPartial(state.current.content)
+      state.content = dropPartial(state.content)
+      state.partial = ''
+    }
+    if (state.current) {
+      state.current.content += data.content
+      state.current.context = data.context
+      state.current.metadata = { ...state.current.metadata, ...data.metadata }
+    }
+    state.content += data.content
+  } else if (data.type === 'block_append') {
+    // Grouped blocks (tables, lists, code) are patched in place
+    const block = state.current
+    if (block?.block_id === data.block_id) {
+      if (data.op === 'row') {
+        (block.rows ||= []).push(data.value)
+        state.content += `| ${data.value.join(' | ')} |`
+      } else if (data.op === 'item') {
+        (block.items ||= []).push(data.value)
+        state.content += data.value.number === undefined ? `- ${data.value.content}` : `${data.value.number}. ${data.value.content}`
+      } else if (data.op === 'line') {
+        block.content += `${data.value}\n`
+        state.content += data.value
+      }
+    }
+  } else if (data.type === 'block_end') {
+    if (state.current) {
+      // Grouped code blocks close with their full body
+      if (data.content !== undefined) state.current.content = data.content
+      state.blocks.push({ ...state.current })
+      state.current = null
+    }
+  } else if (data.type === 'line_break') {
+    state.blocks.push({ type: 'line_break', content: '', block_id: `line_break_${state.blocks.length}` })
+  }
+  return state
+}
+
+const snapshotBlocks = (state) => (
+  state.current ? [...state.blocks, state.current] : [...state.blocks]
+)
+
 const AIPanel = ({ isOpen, onToggle, onApplyContent }) => {
   const [messages, setMessages] = useState([
     {
@@ -250,8 +340,56 @@ const AIPanel = ({ isOpen, onToggle, onApplyContent }) => {
   const [lastAIResponse, setLastAIResponse] = useState('')
   const [currentBlocks, setCurrentBlocks] = useState([])
   const [currentBlock, setCurrentBlock] = useState(null)
+  const [queuePosition, setQueuePosition] = useState(null)
 
   const messagesEndRef = useRef(null)
+  // One WebSocket carries every generation; its messages are routed to streams by stream_id
+  const socketRef = useRef(null)
+  const streamsRef = useRef(new Map())
+
+  const openSocket = () => {
+    const socket = new WebSocket('ws://localhost:8000/ws')
+    socket.onmessage = (event) => {
+      const message = JSON.parse(event.data)
+      const stream = streamsRef.current.get(message.stream_id)
+      if (!stream) return
+      if (message.event_id) stream.lastEventId = message.event_id
+      // Coalesced messages carry an array of events
+      ;(message.events || [message]).forEach(stream.handleEvent)
+    }
+    socket.onclose = () => {
+      if (socketRef.current === socket) socketRef.current = null
+      if (streamsRef.current.size === 0) return
+      // Resume open streams on a new connection; the server replays only what was missed
+      setTimeout(() => {
+        streamsRef.current.forEach((stream, streamId) => {
+          stream.resumes = (stream.resumes || 0) + 1
+          if (!stream.lastEventId || stream.resumes > 3) {
+            stream.handleEvent({ type: 'error', message: 'WebSocket connection lost' })
+            return
+          }
+          sendSocketMessage({ type: 'resume', stream_id: streamId, last_event_id: stream.lastEventId, coalesce_ms: 50 })
+        })
+      }, 1000)
+    }
+    socketRef.current = socket
+    return socket
+  }
+
+  const sendSocketMessage = (message) => {
+    const socket = socketRef.current || openSocket()
+    const payload = JSON.stringify(message)
+    if (socket.readyState === WebSocket.OPEN) {
+      socket.send(payload)
+    } else {
+      socket.addEventListener('open', () => socket.send(payload), { once: true })
+    }
+  }
+
+  useEffect(() => () => {
+    streamsRef.current.clear()
+    socketRef.current?.close()
+  }, [])
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' })
@@ -261,6 +399,29 @@ const AIPanel = ({ isOpen, onToggle, onApplyContent }) => {
     scrollToBottom()
   }, [messages, isLoading])
 
+  // Rebuild the last generated document after a page reload
+  useEffect(() => {
+    const checkpointId = localStorage.getItem('checkpoint_id')
+    if (!checkpointId) return
+
+    let ignore = false
+    fetch(`http://localhost:8000/thread/${checkpointId}/blocks?stream=false`)
+      .then(res => (res.ok ? res.json() : null))
+      .then(data => {
+        if (ignore || !data?.events?.length) return
+        const blockState = data.events.reduce(applyBlockEvent, createBlockState())
+        setLastAIResponse(blockState.content)
+        setMessages(prev => [...prev, {
+          id: Date.now(),
+          type: 'assistant',
+          content: blockState.content,
+          blocks: snapshotBlocks(blockState)
+        }])
+      })
+      .catch(() => {})
+    return () => { ignore = true }
+  }, [])
+
   const handleSendMessage = async () => {
     if (!inputMessage.trim()) return
 
@@ -274,15 +435,12 @@ const AIPanel = ({ isOpen, onToggle, onApplyContent }) => {
     setMessages(prev => [...prev, userMessage])
     setInputMessage('')
     setIsLoading(true)
+    setQueuePosition(null)
     setCurrentBlocks([])
     setCurrentBlock(null)
 
     const checkpointId = localStorage.getItem('checkpoint_id')
-    const url = checkpointId
-      ? `http://localhost:8000/enhanced_chat_stream/${encodeURIComponent(inputMessage)}?checkpoint_id=${checkpointId}`
-      : `http://localhost:8000/enhanced_chat_stream/${encodeURIComponent(inputMessage)}`
-
-    const eventSource = new EventSource(url)
+    const streamId = String(userMessage.id)
 
     let aiMessage = {
       id: Date.now() + 1,
@@ -291,37 +449,20 @@ const AIPanel = ({ isOpen, onToggle, onApplyContent }) => {
       blocks: []
     }
 
-    let accumulatedBlocks = []
-    let currentBlockData = null
-
-    eventSource.onmessage = (event) => {
-      const data = JSON.parse(event.data)
+    const blockState = createBlockState()
 
+    const handleEvent = (data) => {
       if (data.type === 'checkpoint') {
         localStorage.setItem('checkpoint_id', data.checkpoint_id)
-      } else if (data.type === 'block_start') {
-        currentBlockData = {
-          type: data.block_info.type,
-          block_id: data.block_info.block_id,
-          content: '',
-          metadata: data.block_info.metadata,
-          context: {}
-        }
-      } else if (data.type === 'content') {
-        if (currentBlockData) {
-          currentBlockData.content += data.content
-          currentBlockData.context = data.context
-          currentBlockData.metadata = { ...currentBlockData.metadata, ...data.metadata }
-        }
-        
-        aiMessage.content += data.content
+      } else if (['content', 'content_delta', 'block_append'].includes(data.type)) {
+        applyBlockEvent(blockState, data)
+        setQueuePosition(null)
+
+        aiMessage.content = blockState.content
         setLastAIResponse(aiMessage.content)
         
         // Update current blocks for real-time display
-        const updatedBlocks = [...accumulatedBlocks]
-        if (currentBlockData) {
-          updatedBlocks.push(currentBlockData)
-        }
+        const updatedBlocks = snapshotBlocks(blockState)
         
         setCurrentBlocks(updatedBlocks)
         aiMessage.blocks = updatedBlocks
@@ -333,26 +474,33 @@ const AIPanel = ({ isOpen, onToggle, onApplyContent }) => {
           }
           return [...prev, { ...aiMessage }]
         })
-      } else if (data.type === 'block_end') {
-        if (currentBlockData) {
-          accumulatedBlocks.push({ ...currentBlockData })
-          currentBlockData = null
-        }
-      } else if (data.type === 'line_break') {
-        accumulatedBlocks.push({ type: 'line_break', content: '', block_id: `line_break_${Date.now()}` })
+      } else if (['block_start', 'block_end', 'line_break'].includes(data.type)) {
+        applyBlockEvent(blockState, data)
+      } else if (data.type === 'queue_position') {
+        setQueuePosition(data.position)
+      } else if (data.type === 'error') {
+        streamsRef.current.delete(streamId)
+        setIsLoading(false)
+        setCurrentBlocks([])
+        console.error(data.message)
       } else if (data.type === 'end') {
-        eventSource.close()
+        streamsRef.current.delete(streamId)
         setIsLoading(false)
         setCurrentBlocks([])
       }
     }
 
-    eventSource.onerror = () => {
-      eventSource.close()
-      setIsLoading(false)
-      setCurrentBlocks([])
-      console.error('SSE connection error')
-    }
+    streamsRef.current.set(streamId, { handleEvent })
+    // Stream partial lines, batched by the server into one message every 50ms
+    sendSocketMessage({
+      type: 'prompt',
+      stream_id: streamId,
+      message: inputMessage,
+      checkpoint_id: checkpointId,
+      coalesce_ms: 50,
+      incremental: true,
+      grouped: true
+    })
   }
 
   const handleKeyPress = (e) => {
@@ -432,6 +580,8 @@ const AIPanel = ({ isOpen, onToggle, onApplyContent }) => {
                     <div className="w-2 h-2 bg-gray-400 rounded-full animate-bounce" style={{ animationDelay: '0.2s' }}></div>
                   </div>
                 </div>
+              ) : queuePosition ? (
+                <div className="text-sm text-gray-500">Waiting in queue (#{queuePosition})</div>
               ) : (
                 <div className="flex space-x-1">
                   <div className="w-2 h-2 bg-gray-400 rounded-full animate-bounce"></div>
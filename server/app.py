@@ -1,26 +1,758 @@
-from typing import TypedDict, Annotated, Optional, Dict, Any, List
+import time
+IMPORT_STARTED = time.perf_counter()
+from typing import TypedDict, Annotated, Optional, Dict, Any, List, AsyncIterator, NotRequired, Literal
 from langgraph.graph import add_messages, StateGraph, END
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage, AIMessageChunk, SystemMessage
+from langchain_core.callbacks.manager import adispatch_custom_event
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, SystemMessage, RemoveMessage, ToolMessage, get_buffer_string
+from langchain_core.messages.tool import tool_call_chunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import ensure_config
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
 from dotenv import load_dotenv
 from langchain_tavily import TavilySearch
-from langchain_groq import ChatGroq
-from fastapi import FastAPI, Query
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Header, Query, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
+import asyncio
+import errno
+import functools
+import hashlib
+import inspect
 import json
+import os
+import pickle
+import random
 import re
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit
 from uuid import uuid4
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.prebuilt import ToolNode
 from enum import Enum
 
+try:
+    import orjson
+except ImportError:  # optional, stream events fall back to the stdlib encoder
+    orjson = None
+
 load_dotenv()
 
-memory = MemorySaver()
+# Multi-worker mode (uvicorn --workers N): checkpoints, caches and thread locks are kept
+# under this directory so any worker can serve any thread
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# How long a turn waits for another turn on the same thread to finish
+THREAD_LOCK_TIMEOUT_SECONDS = float(os.getenv("THREAD_LOCK_TIMEOUT_SECONDS", "120"))
+
+# Checkpointer backend: "memory" (unbounded), "lru" (bounded in-memory) or "sqlite" (file-backed)
+CHECKPOINTER = os.getenv("CHECKPOINTER", "sqlite" if SHARED_STATE_DIR else "lru")
+CHECKPOINTER_SQLITE_PATH = os.getenv("CHECKPOINTER_SQLITE_PATH", os.path.join(SHARED_STATE_DIR or "", "checkpoints.sqlite"))
+CHECKPOINTER_MAX_THREADS = int(os.getenv("CHECKPOINTER_MAX_THREADS", "1000"))
+CHECKPOINTER_MAX_BYTES = int(os.getenv("CHECKPOINTER_MAX_BYTES", str(256 * 1024 * 1024)))
+CHECKPOINTER_TTL_SECONDS = float(os.getenv("CHECKPOINTER_TTL_SECONDS", str(24 * 60 * 60)))
+
+# Prompt budget for each model call (system prompt + summary + history), in approximate tokens
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "6000"))
+# Fold turns that fall outside the budget into a rolling summary instead of just not sending them
+HISTORY_SUMMARIZE = os.getenv("HISTORY_SUMMARIZE", "false").lower() in ("1", "true", "yes")
+
+# Response and search caches; set MAX_ENTRIES to 0 to disable
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "3600"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1024"))
+
+# Admission control for provider calls: concurrent calls and queued callers per provider
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "8"))
+MODEL_QUEUE_SIZE = int(os.getenv("MODEL_QUEUE_SIZE", "64"))
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", "4"))
+SEARCH_QUEUE_SIZE = int(os.getenv("SEARCH_QUEUE_SIZE", "64"))
+QUEUE_POSITION_INTERVAL_SECONDS = float(os.getenv("QUEUE_POSITION_INTERVAL_SECONDS", "0.5"))
+# Retries for provider 429s, with full-jitter exponential backoff
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "3"))
+RATE_LIMIT_BACKOFF_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_SECONDS", "0.5"))
+RATE_LIMIT_BACKOFF_MAX_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_MAX_SECONDS", "8"))
+
+# Per-query deadline when the model requests several searches in one step
+SEARCH_TIMEOUT_SECONDS = float(os.getenv("SEARCH_TIMEOUT_SECONDS", "15"))
+# Compaction of search output before it reaches the model and the thread state
+SEARCH_MIN_SCORE = float(os.getenv("SEARCH_MIN_SCORE", "0.3"))
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "500"))
+SEARCH_DEDUP_DOMAINS = os.getenv("SEARCH_DEDUP_DOMAINS", "true").lower() in ("1", "true", "yes")
+# Approximate tokens of search output per model step, split evenly across its queries
+SEARCH_TOOL_TOKEN_BUDGET = int(os.getenv("SEARCH_TOOL_TOKEN_BUDGET", "1500"))
+# Start a search for fresh-data prompts alongside the first model call of a turn
+SEARCH_PREFETCH = os.getenv("SEARCH_PREFETCH", "false").lower() in ("1", "true", "yes")
+# Minimum word overlap (Jaccard) between the prefetched query and a model search call to reuse it
+SEARCH_PREFETCH_MIN_OVERLAP = float(os.getenv("SEARCH_PREFETCH_MIN_OVERLAP", "0.3"))
+
+# Model routing: "provider:model" for each tier; STRONG_MODEL defaults to FAST_MODEL (no routing)
+FAST_MODEL = os.getenv("FAST_MODEL", "groq:llama3-8b-8192")
+STRONG_MODEL = os.getenv("STRONG_MODEL", FAST_MODEL)
+# A turn goes to the strong model when its request or prompt crosses any of these
+ROUTE_STRONG_MIN_REQUEST_CHARS = int(os.getenv("ROUTE_STRONG_MIN_REQUEST_CHARS", "800"))
+ROUTE_STRONG_MIN_PROMPT_TOKENS = int(os.getenv("ROUTE_STRONG_MIN_PROMPT_TOKENS", "3000"))
+ROUTE_STRONG_STRUCTURE = os.getenv(
+    "ROUTE_STRONG_STRUCTURE",
+    r"\b(tables?|code|script|function|step[- ]by[- ]step|outline|compare|comparison|detailed|in[- ]depth|essay|report|strategy|plan)\b",
+)
+
+# Resumable streams: frames kept per generation for Last-Event-ID replay, and how long
+# finished generations stay resumable
+STREAM_BUFFER_EVENTS = int(os.getenv("STREAM_BUFFER_EVENTS", "2000"))
+STREAM_RUN_TTL_SECONDS = float(os.getenv("STREAM_RUN_TTL_SECONDS", "300"))
+STREAM_MAX_FINISHED_RUNS = int(os.getenv("STREAM_MAX_FINISHED_RUNS", "256"))
+# Once the last client of a generation disconnects it is cancelled, model and search calls
+# included, unless a client resumes it within this many seconds
+STREAM_DISCONNECT_GRACE_SECONDS = float(os.getenv("STREAM_DISCONNECT_GRACE_SECONDS", "15"))
+
+# Batch generation: jobs accepted per request and how many of a batch's jobs run at once
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "100"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# Local stand-ins for benchmarks and tests: FAST_MODEL=fake:<label>, SEARCH_BACKEND=fake
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "tavily")
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "100"))  # 0 streams without delay
+FAKE_LLM_TOKEN_CHARS = int(os.getenv("FAKE_LLM_TOKEN_CHARS", "4"))
+FAKE_LLM_RESPONSE_PATH = os.getenv("FAKE_LLM_RESPONSE_PATH")
+FAKE_SEARCH_LATENCY_MS = float(os.getenv("FAKE_SEARCH_LATENCY_MS", "100"))
+
+class BoundedMemorySaver(MemorySaver):
+    """In-memory checkpointer that evicts whole threads by LRU order, idle TTL and a byte budget"""
+
+    def __init__(self, max_threads: int = 1000, max_bytes: int = 256 * 1024 * 1024, ttl_seconds: Optional[float] = None):
+        super().__init__()
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.total_bytes = 0
+        self._last_access: "OrderedDict[str, float]" = OrderedDict()
+        self._thread_bytes: Dict[str, int] = {}
+        self._thread_blob_keys: Dict[str, set] = {}
+        self._thread_write_keys: Dict[str, set] = {}
+        self._write_bytes: Dict[tuple, int] = {}
+
+    def _touch(self, thread_id: str):
+        self._last_access[thread_id] = time.monotonic()
+        self._last_access.move_to_end(thread_id)
+
+    def _is_expired(self, thread_id: str, now: float) -> bool:
+        last_access = self._last_access.get(thread_id)
+        return self.ttl_seconds is not None and last_access is not None and now - last_access > self.ttl_seconds
+
+    def _account(self, thread_id: str, size: int):
+        self._thread_bytes[thread_id] = self._thread_bytes.get(thread_id, 0) + size
+        self.total_bytes += size
+
+    def _evict(self, keep: str):
+        """Drop expired threads, then least recently used ones until back under budget"""
+        now = time.monotonic()
+        for thread_id in list(self._last_access):
+            if not self._is_expired(thread_id, now):
+                break
+            if thread_id != keep:
+                self.delete_thread(thread_id)
+        
+        while len(self._last_access) > self.max_threads or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._last_access))
+            if oldest == keep:
+                # Never evict the thread being written, even if it alone exceeds the budget
+                break
+            self.delete_thread(oldest)
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        # Unknown or evicted threads are answered without touching storage, a defaultdict
+        # that would otherwise keep an untracked entry for every id ever looked up
+        if thread_id not in self._last_access:
+            return None
+        if self._is_expired(thread_id, time.monotonic()):
+            self.delete_thread(thread_id)
+            return None
+        self._touch(thread_id)
+        return super().get_tuple(config)
+
+    def list(self, config, **kwargs):
+        if config and config["configurable"]["thread_id"] not in self._last_access:
+            return iter(())
+        return super().list(config, **kwargs)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        result = super().put(config, checkpoint, metadata, new_versions)
+        
+        blob_keys = self._thread_blob_keys.setdefault(thread_id, set())
+        size = 0
+        for channel, version in new_versions.items():
+            key = (thread_id, checkpoint_ns, channel, version)
+            if key not in blob_keys:
+                blob_keys.add(key)
+                size += len(self.blobs[key][1])
+        saved_checkpoint, saved_metadata, _ = self.storage[thread_id][checkpoint_ns][checkpoint["id"]]
+        size += len(saved_checkpoint[1]) + len(saved_metadata[1])
+        self._account(thread_id, size)
+        
+        self._touch(thread_id)
+        self._evict(keep=thread_id)
+        return result
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        super().put_writes(config, writes, task_id, task_path)
+        thread_id = config["configurable"]["thread_id"]
+        outer_key = (thread_id, config["configurable"].get("checkpoint_ns", ""), config["configurable"]["checkpoint_id"])
+        
+        # Writes for a checkpoint accumulate in one entry, so re-measure the whole entry
+        size = sum(len(value[1]) for _, _, value, _ in self.writes[outer_key].values())
+        self._account(thread_id, size - self._write_bytes.get(outer_key, 0))
+        self._write_bytes[outer_key] = size
+        self._thread_write_keys.setdefault(thread_id, set()).add(outer_key)
+        
+        self._touch(thread_id)
+        self._evict(keep=thread_id)
+
+    def delete_thread(self, thread_id: str) -> None:
+        # Uses the tracked keys instead of scanning every blob and write in the store
+        self.storage.pop(thread_id, None)
+        for key in self._thread_blob_keys.pop(thread_id, ()):
+            self.blobs.pop(key, None)
+        for key in self._thread_write_keys.pop(thread_id, ()):
+            self.writes.pop(key, None)
+            self._write_bytes.pop(key, None)
+        self.total_bytes -= self._thread_bytes.pop(thread_id, 0)
+        self._last_access.pop(thread_id, None)
+
+@asynccontextmanager
+async def create_checkpointer(backend: str = CHECKPOINTER) -> AsyncIterator[BaseCheckpointSaver]:
+    """Build the configured checkpointer for the lifetime of the app"""
+    if backend == "sqlite":
+        # Optional dependency, only needed for the file-backed store
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        
+        async with AsyncSqliteSaver.from_conn_string(CHECKPOINTER_SQLITE_PATH) as saver:
+            # Other workers write to the same file; wait for their locks instead of failing
+            await saver.conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+            await saver.setup()
+            yield saver
+    elif backend == "lru":
+        yield BoundedMemorySaver(
+            max_threads=CHECKPOINTER_MAX_THREADS,
+            max_bytes=CHECKPOINTER_MAX_BYTES,
+            ttl_seconds=CHECKPOINTER_TTL_SECONDS or None,
+        )
+    elif backend == "memory":
+        yield MemorySaver()
+    else:
+        raise ValueError(f"Unknown CHECKPOINTER backend: {backend!r}")
+
+memory: Optional[BaseCheckpointSaver] = None
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire a fixed time after being set"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Async callers use these; backends that block override them to run off the event loop
+    async def aget(self, key: str) -> Optional[Any]:
+        return self.get(key)
+
+    async def aset(self, key: str, value: Any):
+        self.set(key, value)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SqliteTTLCache(TTLCache):
+    """TTLCache kept in a SQLite table so all worker processes share it.
+
+    Entries are pickled and expire by wall-clock time; once over max_entries the ones
+    closest to expiry are dropped. Queries can wait up to SQLITE_BUSY_TIMEOUT_MS on another
+    worker's write, so async callers run them in a thread, one at a time per connection.
+    """
+
+    PRUNE_EVERY = 64
+
+    def __init__(self, path: str, table: str, max_entries: int, ttl_seconds: float):
+        super().__init__(max_entries, ttl_seconds)
+        self.table = table
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, expires REAL, value BLOB)")
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT expires, value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(row[1])
+
+    def set(self, key: str, value: Any):
+        if self.max_entries <= 0:
+            return
+        value = pickle.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, expires, value) VALUES (?, ?, ?)",
+                (key, time.time() + self.ttl_seconds, value),
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE expires < ?", (time.time(),))
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key NOT IN (SELECT key FROM {self.table} ORDER BY expires DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Any):
+        await asyncio.to_thread(self.set, key, value)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+def create_cache(name: str, max_entries: int, ttl_seconds: float) -> TTLCache:
+    if SHARED_STATE_DIR and max_entries > 0:
+        return SqliteTTLCache(os.path.join(SHARED_STATE_DIR, "cache.sqlite"), f"{name}_cache", max_entries, ttl_seconds)
+    return TTLCache(max_entries, ttl_seconds)
+
+class ThreadBusyError(Exception):
+    """Another turn on the same thread did not finish within THREAD_LOCK_TIMEOUT_SECONDS"""
+
+class ThreadLocks:
+    """Serializes turns on the same thread, across worker processes when lock_dir is set.
+
+    Each thread gets an asyncio.Lock in this process, kept only while a turn holds or waits
+    for it. Across workers, a thread is one byte of a single shared lock file under lock_dir,
+    at an offset taken from its hash and locked with lockf().
+    """
+
+    POLL_SECONDS = 0.05
+    # Byte offsets thread ids hash to; the file stays empty, locks past EOF are fine
+    OFFSETS = 2 ** 62
+
+    def __init__(self, lock_dir: Optional[str] = None):
+        self.lock_dir = lock_dir
+        # thread_id -> [lock, turns holding or waiting for it]
+        self._locks: Dict[str, list] = {}
+        # Byte-range locks belong to the process, so one descriptor serves every turn and
+        # offsets are counted here: two threads on one offset must not unlock each other
+        self._fd: Optional[int] = None
+        self._held: Dict[int, int] = {}
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+            self._fd = os.open(os.path.join(lock_dir, "threads.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str, timeout: float = THREAD_LOCK_TIMEOUT_SECONDS):
+        deadline = time.monotonic() + timeout
+        entry = self._locks.get(thread_id)
+        if entry is None:
+            entry = self._locks[thread_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise ThreadBusyError(f"Thread {thread_id} is busy with another request") from None
+            try:
+                offset = await self._lock_range(thread_id, deadline) if self._fd is not None else None
+                try:
+                    yield
+                finally:
+                    if offset is not None:
+                        self._unlock_range(offset)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[thread_id]
+
+    async def _lock_range(self, thread_id: str, deadline: float) -> int:
+        # Only imported with a lock_dir, which multi-worker (POSIX) deployments set
+        import fcntl
+        
+        offset = int(hashlib.sha256(thread_id.encode()).hexdigest()[:16], 16) % self.OFFSETS
+        if offset in self._held:
+            self._held[offset] += 1
+            return offset
+        while True:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                break
+            except OSError as error:
+                if error.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            if time.monotonic() >= deadline:
+                raise ThreadBusyError(f"Thread {thread_id} is busy with another request")
+            await asyncio.sleep(self.POLL_SECONDS)
+            if offset in self._held:
+                # Another turn in this process took the offset while we waited
+                self._held[offset] += 1
+                return offset
+        self._held[offset] = 1
+        return offset
+
+    def _unlock_range(self, offset: int):
+        import fcntl
+        
+        self._held[offset] -= 1
+        if self._held[offset] == 0:
+            del self._held[offset]
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+thread_locks = ThreadLocks(os.path.join(SHARED_STATE_DIR, "locks") if SHARED_STATE_DIR else None)
+
+def normalize_text(text: Any) -> str:
+    """Collapse whitespace and case so trivially different search queries share a cache key"""
+    return " ".join(str(text).split()).lower()
+
+def cache_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+response_cache = create_cache("response", RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+search_cache = create_cache("search", SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_SECONDS)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+EVENTS_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+class Histogram:
+    """Cumulative histogram rendered in the Prometheus text format"""
+
+    def __init__(self, name: str, documentation: str, buckets: tuple, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labelnames = labelnames
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            label_text = ",".join(f'{name}="{value}"' for name, value in zip(self.labelnames, labels))
+            prefix = f"{label_text}," if label_text else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-2]}')
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{suffix} {series[-2]}")
+        return lines
+
+class Counter:
+    """Monotonic counter rendered in the Prometheus text format"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            label_text = ",".join(f'{name}="{label}"' for name, label in zip(self.labelnames, labels))
+            lines.append(f"{self.name}{{{label_text}}} {value}" if label_text else f"{self.name} {value}")
+        return lines
+
+REQUEST_SECONDS = Histogram("chat_request_seconds", "Stream duration per request", LATENCY_BUCKETS, ("endpoint",))
+QUEUE_WAIT_SECONDS = Histogram("chat_queue_wait_seconds", "Time waiting for a provider slot", LATENCY_BUCKETS, ("resource",))
+FIRST_TOKEN_SECONDS = Histogram("chat_time_to_first_token_seconds", "Request start to first model token", LATENCY_BUCKETS, ("endpoint",))
+NODE_SECONDS = Histogram("chat_node_seconds", "Graph node duration", LATENCY_BUCKETS, ("node",))
+PARSER_SECONDS = Histogram("chat_parser_seconds", "Time spent in the block parser per request", LATENCY_BUCKETS)
+STREAM_BYTES = Histogram("chat_stream_bytes", "SSE bytes emitted per request", BYTES_BUCKETS, ("endpoint",))
+STREAM_EVENTS = Histogram("chat_stream_events", "SSE events emitted per request", EVENTS_BUCKETS, ("endpoint",))
+TOKENS_PER_SECOND = Histogram("chat_tokens_per_second", "Model output rate while generating", TOKENS_PER_SECOND_BUCKETS, ("endpoint",))
+CANCELLED_RUNS = Counter("chat_cancelled_runs_total", "Generations cancelled because every client disconnected")
+HISTOGRAMS = (REQUEST_SECONDS, QUEUE_WAIT_SECONDS, FIRST_TOKEN_SECONDS, NODE_SECONDS, PARSER_SECONDS, STREAM_BYTES, STREAM_EVENTS, TOKENS_PER_SECOND)
+
+class RequestTiming:
+    """Latency breakdown of one streamed request.
+
+    Passed to the graph as configurable["request_timing"] so nodes and provider calls
+    can add to it; the stream handler fills in the rest.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.queue_wait: Dict[str, float] = {}
+        self.nodes: Dict[str, float] = {}
+        self.first_token: Optional[float] = None
+        self.parser = 0.0
+        self.events = 0
+        self.bytes = 0
+        self.tokens = 0
+        self.generating = 0.0
+        self._generation_started: Optional[float] = None
+
+    def token(self):
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now - self.started
+        if self._generation_started is None:
+            self._generation_started = now
+        self.tokens += 1
+
+    def generation_end(self):
+        if self._generation_started is not None:
+            self.generating += time.perf_counter() - self._generation_started
+            self._generation_started = None
+
+    def frame(self, frame: str):
+        self.events += 1
+        self.bytes += len(frame.encode())
+
+    def tokens_per_second(self) -> Optional[float]:
+        return self.tokens / self.generating if self.generating > 0 else None
+
+    def observe(self):
+        REQUEST_SECONDS.observe(time.perf_counter() - self.started, self.endpoint)
+        if self.first_token is not None:
+            FIRST_TOKEN_SECONDS.observe(self.first_token, self.endpoint)
+        PARSER_SECONDS.observe(self.parser)
+        STREAM_BYTES.observe(self.bytes, self.endpoint)
+        STREAM_EVENTS.observe(self.events, self.endpoint)
+        if self.tokens_per_second() is not None:
+            TOKENS_PER_SECOND.observe(self.tokens_per_second(), self.endpoint)
+
+    def summary(self) -> Dict[str, Any]:
+        milliseconds = lambda seconds: round(seconds * 1000, 2)
+        tokens_per_second = self.tokens_per_second()
+        return {
+            "total_ms": milliseconds(time.perf_counter() - self.started),
+            "queue_wait_ms": {resource: milliseconds(seconds) for resource, seconds in self.queue_wait.items()},
+            "first_token_ms": milliseconds(self.first_token) if self.first_token is not None else None,
+            "nodes_ms": {node: milliseconds(seconds) for node, seconds in self.nodes.items()},
+            "parser_ms": milliseconds(self.parser),
+            "events": self.events,
+            "bytes": self.bytes,
+            "tokens": self.tokens,
+            "tokens_per_second": round(tokens_per_second, 1) if tokens_per_second is not None else None,
+        }
+
+def current_request_timing() -> Optional[RequestTiming]:
+    """The RequestTiming of the graph run this code executes in, if any"""
+    return ensure_config().get("configurable", {}).get("request_timing")
+
+def record_queue_wait(resource: str, seconds: float):
+    QUEUE_WAIT_SECONDS.observe(seconds, resource)
+    timing = current_request_timing()
+    if timing is not None:
+        timing.queue_wait[resource] = timing.queue_wait.get(resource, 0.0) + seconds
+
+def timed_node(name: str, node):
+    """Wrap a graph node so its duration is recorded in NODE_SECONDS and the request timing"""
+    async def run(state: State, config):
+        started = time.perf_counter()
+        try:
+            return await node(state, config)
+        finally:
+            seconds = time.perf_counter() - started
+            NODE_SECONDS.observe(seconds, name)
+            timing = config.get("configurable", {}).get("request_timing")
+            if timing is not None:
+                timing.nodes[name] = timing.nodes.get(name, 0.0) + seconds
+    return run
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.extend(CANCELLED_RUNS.render())
+    
+    counters = {
+        "model_route_calls_total": ("Model calls per route", lambda route: route.calls),
+        "model_route_errors_total": ("Failed model calls per route", lambda route: route.errors),
+        "model_route_cache_hits_total": ("Response cache hits per route", lambda route: route.cache_hits),
+        "model_route_seconds_total": ("Model call time per route", lambda route: route.seconds),
+    }
+    # Only routes already built; a scrape never constructs providers
+    routes = get_model_routes.peek() or {}
+    for name, (documentation, value) in counters.items():
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} counter"]
+        lines += [f'{name}{{route="{route.name}"}} {value(route)}' for route in routes.values()]
+    
+    gauges = {
+        "limiter_active": ("Provider calls in flight", lambda limiter: limiter.active),
+        "limiter_waiting": ("Provider calls queued", lambda limiter: limiter.waiting),
+    }
+    for name, (documentation, value) in gauges.items():
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{resource="{limiter.name}"}} {value(limiter)}' for limiter in (model_limiter, search_limiter)]
+    
+    lines += ["# HELP app_startup_seconds Import, checkpointer and warm-up time of this process", "# TYPE app_startup_seconds gauge"]
+    lines += [f'app_startup_seconds{{phase="{phase}"}} {seconds:.6f}' for phase, seconds in startup_timings.items()]
+    
+    lines += ["# HELP cache_requests_total Cache lookups by result", "# TYPE cache_requests_total counter"]
+    for name, cache in (("response", response_cache), ("search", search_cache)):
+        lines.append(f'cache_requests_total{{cache="{name}",result="hit"}} {cache.hits}')
+        lines.append(f'cache_requests_total{{cache="{name}",result="miss"}} {cache.misses}')
+    return "\n".join(lines) + "\n"
+
+class QueueFullError(Exception):
+    """Raised when a limiter's wait queue is already at capacity"""
+
+class ConcurrencyLimiter:
+    """FIFO semaphore with a bounded wait queue that can report each waiter's position"""
+
+    def __init__(self, name: str, limit: int, max_waiting: int):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self._waiters: deque = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def is_full(self) -> bool:
+        return self.active >= self.limit and len(self._waiters) >= self.max_waiting
+
+    @asynccontextmanager
+    async def slot(self, on_wait=None):
+        """Hold one slot; on_wait(position) is awaited whenever the queue position changes"""
+        await self._acquire(on_wait)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, on_wait):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_waiting:
+            raise QueueFullError(f"Too many queued {self.name} requests")
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        reported = None
+        try:
+            while not waiter.done():
+                position = self._waiters.index(waiter) + 1
+                if on_wait is not None and position != reported:
+                    reported = position
+                    await on_wait(position)
+                await asyncio.wait([waiter], timeout=QUEUE_POSITION_INTERVAL_SECONDS)
+        except BaseException:
+            if waiter.done():
+                # The slot was handed over while we were being cancelled
+                self._release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        # Hand the slot straight to the next waiter so late arrivals cannot jump the queue
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+model_limiter = ConcurrencyLimiter("model", MODEL_CONCURRENCY, MODEL_QUEUE_SIZE)
+search_limiter = ConcurrencyLimiter("search", SEARCH_CONCURRENCY, SEARCH_QUEUE_SIZE)
+
+def queue_position_reporter(resource: str):
+    """on_wait callback that surfaces queue positions as `queue_position` stream events"""
+    async def report(position: int):
+        await adispatch_custom_event("queue_position", {"resource": resource, "position": position})
+    return report
+
+def is_rate_limited(error: BaseException) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    # Tavily reports HTTP failures as plain exceptions: "Error 429: Too Many Requests"
+    return status == 429 or str(error).startswith("Error 429")
+
+def backoff_delay(attempt: int, error: BaseException) -> float:
+    retry_after = getattr(getattr(error, "response", None), "headers", {}).get("retry-after")
+    if retry_after:
+        try:
+            return min(float(retry_after), RATE_LIMIT_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RATE_LIMIT_BACKOFF_MAX_SECONDS, RATE_LIMIT_BACKOFF_SECONDS * 2 ** attempt))
+
+async def with_rate_limit_retry(call):
+    """Await call(), retrying provider 429s with jittered exponential backoff"""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            return await call()
+        except Exception as error:
+            if attempt == RATE_LIMIT_RETRIES or not is_rate_limited(error):
+                raise
+            await asyncio.sleep(backoff_delay(attempt, error))
+
+async def invoke_model(model, messages, **kwargs):
+    """Call a chat model under the model concurrency limit"""
+    waiting = time.perf_counter()
+    async with model_limiter.slot(on_wait=queue_position_reporter("model")):
+        record_queue_wait("model", time.perf_counter() - waiting)
+        return await with_rate_limit_retry(lambda: model.ainvoke(messages, **kwargs))
 
 class State(TypedDict):
     messages: Annotated[list, add_messages]
+    # Rolling summary of turns that were folded out of `messages`
+    summary: NotRequired[str]
+    # Parsed stream events of the latest generation, replayed by /thread/{id}/blocks
+    blocks: NotRequired[list]
 
 class BlockType(Enum):
     HEADING_1 = "heading_1"
@@ -46,11 +778,284 @@ class ContentType(Enum):
     TEXT_WITH_LINKS = "text_with_links"
     TEXT_WITH_CODE = "text_with_code"
 
-search_tool = TavilySearch(max_results=4)
-tools = [search_tool]
-# llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash")
-llm=ChatGroq(model="llama3-8b-8192")
-llm_with_tools = llm.bind_tools(tools=tools)
+# Searches in flight by cache key -> [task, waiters], so concurrent identical queries
+# (the jobs of a batch, most often) share one call instead of all missing the cache
+search_inflight: Dict[str, list] = {}
+
+class CachedTavilySearch(TavilySearch):
+    """TavilySearch that answers repeated queries from search_cache"""
+
+    async def _arun(self, query: str, run_manager=None, **kwargs: Any) -> Dict[str, Any]:
+        key = cache_key(normalize_text(query), kwargs)
+        cached = await search_cache.aget(key)
+        if cached is not None:
+            return cached
+        
+        entry = search_inflight.get(key)
+        if entry is None:
+            entry = search_inflight[key] = [asyncio.ensure_future(self._cached_search(key, query, run_manager, **kwargs)), 0]
+            
+            def forget(_):
+                if search_inflight.get(key) is entry:
+                    del search_inflight[key]
+            entry[0].add_done_callback(forget)
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            # The last caller to give up cancels the search, as if it had been its own
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+    async def _cached_search(self, key: str, query: str, run_manager=None, **kwargs: Any) -> Dict[str, Any]:
+        search_once = self._search
+        
+        async def search():
+            result = await search_once(query, run_manager=run_manager, **kwargs)
+            # TavilySearch returns errors instead of raising; raise 429s so they are retried
+            if "error" in result and is_rate_limited(result["error"]):
+                raise result["error"]
+            return result
+        
+        waiting = time.perf_counter()
+        async with search_limiter.slot(on_wait=queue_position_reporter("search")):
+            record_queue_wait("search", time.perf_counter() - waiting)
+            try:
+                result = await with_rate_limit_retry(search)
+            except Exception as error:
+                if not is_rate_limited(error):
+                    raise
+                result = {"error": error}
+        
+        if "error" not in result:
+            await search_cache.aset(key, result)
+        return result
+
+    async def _search(self, query: str, run_manager=None, **kwargs: Any) -> Dict[str, Any]:
+        return await super()._arun(query, run_manager=run_manager, **kwargs)
+
+class FakeTavilySearch(CachedTavilySearch):
+    """Deterministic local search results after FAKE_SEARCH_LATENCY_MS, with no API calls"""
+
+    async def _search(self, query: str, run_manager=None, **kwargs: Any) -> Dict[str, Any]:
+        await asyncio.sleep(FAKE_SEARCH_LATENCY_MS / 1000)
+        slug = hashlib.sha256(normalize_text(query).encode()).hexdigest()[:8]
+        return {
+            "query": query,
+            "results": [
+                {
+                    "url": f"https://source{index}.example.com/{slug}",
+                    "title": f"Result {index + 1} for {query}",
+                    "content": f"Snippet {index + 1} about {query}. " * 8,
+                    "score": round(1 - index * 0.1, 2),
+                }
+                for index in range(self.max_results or 5)
+            ],
+        }
+
+FAKE_RESPONSE = """# Fake response
+A paragraph with **bold**, *italic*, `inline code` and a [link](https://example.com).
+
+## Steps
+1. First step
+2. Second step with `code`
+- A bullet
+- Another bullet
+
+> A quoted line
+
+| Name | Value |
+|:-----|------:|
+| alpha | 1 |
+| beta | 2 |
+
+```python
+def main():
+    return "done"
+```
+---
+Closing paragraph.
+"""
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Deterministic local chat model that streams a fixed response.
+
+    Tokens of token_chars characters are emitted at tokens_per_second. Once bound to the
+    tools, a call whose request looks like it needs fresh data asks for a search instead;
+    unbound calls, such as history summaries, always answer.
+    """
+
+    response: str = FAKE_RESPONSE
+    tokens_per_second: float = 100
+    token_chars: int = 4
+    tools_bound: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={"tools_bound": True})
+
+    def _message(self, messages) -> AIMessage:
+        last = messages[-1]
+        if self.tools_bound and isinstance(last, HumanMessage) and isinstance(last.content, str) and FRESH_DATA_PATTERN.search(last.content):
+            return AIMessage(content="", tool_calls=[{
+                "name": SEARCH_TOOL_NAME,
+                "args": {"query": " ".join(last.content.split())[:100]},
+                "id": f"call_{len(messages)}",
+            }])
+        return AIMessage(content=self.response)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # Paced against the start time so sleep overshoot does not accumulate
+        message = self._message(messages)
+        content = message.content
+        started = time.perf_counter()
+        for index, start in enumerate(range(0, len(content), self.token_chars)):
+            if self.tokens_per_second > 0:
+                await asyncio.sleep(max(0.0, started + index / self.tokens_per_second - time.perf_counter()))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=content[start:start + self.token_chars]))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                tool_call_chunk(name=call["name"], args=json.dumps(call["args"]), id=call["id"], index=index)
+                for index, call in enumerate(message.tool_calls)
+            ]))
+
+def create_fake_llm(label: str) -> FakeStreamingChatModel:
+    response = FAKE_RESPONSE
+    if FAKE_LLM_RESPONSE_PATH:
+        with open(FAKE_LLM_RESPONSE_PATH, encoding="utf-8") as file:
+            response = file.read()
+    return FakeStreamingChatModel(response=response, tokens_per_second=FAKE_LLM_TOKENS_PER_SECOND, token_chars=FAKE_LLM_TOKEN_CHARS)
+
+def built_once(factory):
+    """Build factory(...) on first use, once per distinct arguments (defaults included).
+
+    Concurrent first calls, e.g. the background warm-up and an early request, share
+    one build. The build lock blocks, so code on the event loop uses `await get.abuild()`,
+    which waits for a first build in a worker thread, or `get.peek()`, which never builds.
+    """
+    signature = inspect.signature(factory)
+    lock = threading.Lock()
+    built: Dict[tuple, Any] = {}
+    
+    def key_of(args, kwargs) -> tuple:
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return tuple(bound.arguments.values())
+    
+    @functools.wraps(factory)
+    def get(*args, **kwargs):
+        key = key_of(args, kwargs)
+        if key not in built:
+            with lock:
+                if key not in built:
+                    built[key] = factory(*args, **kwargs)
+        return built[key]
+    
+    async def abuild(*args, **kwargs):
+        key = key_of(args, kwargs)
+        if key in built:
+            return built[key]
+        return await asyncio.to_thread(get, *args, **kwargs)
+    
+    def peek(*args, **kwargs):
+        return built.get(key_of(args, kwargs))
+    
+    get.abuild = abuild
+    get.peek = peek
+    return get
+
+# TavilySearch's tool name, which the fake backend keeps
+SEARCH_TOOL_NAME = TavilySearch.model_fields["name"].default
+
+@built_once
+def get_search_tool(backend: str = SEARCH_BACKEND) -> CachedTavilySearch:
+    if backend == "fake":
+        return FakeTavilySearch(max_results=4, tavily_api_key="fake")
+    if backend == "tavily":
+        return CachedTavilySearch(max_results=4)
+    raise ValueError(f"Unknown SEARCH_BACKEND {backend!r}")
+
+def get_tools() -> list:
+    return [get_search_tool()]
+
+def create_groq_llm(name: str) -> BaseChatModel:
+    from langchain_groq import ChatGroq
+    return ChatGroq(model=name)
+
+def create_google_llm(name: str) -> BaseChatModel:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=name)
+
+# Chat model factories by provider name; register another one to plug in a local or fake model.
+# Provider SDKs are imported by their factory, so only configured providers are ever loaded.
+MODEL_PROVIDERS = {
+    "groq": create_groq_llm,
+    "google": create_google_llm,
+    "fake": create_fake_llm,
+}
+
+def create_llm(spec: str) -> BaseChatModel:
+    provider, _, name = spec.partition(":")
+    if provider not in MODEL_PROVIDERS:
+        raise ValueError(f"Unknown model provider {provider!r} in {spec!r}")
+    return MODEL_PROVIDERS[provider](name)
+
+class ModelRoute:
+    """One routing tier: a chat model bound to the tools, plus per-route counters"""
+
+    def __init__(self, name: str, llm: BaseChatModel, spec: str = ""):
+        self.name = name
+        self.spec = spec
+        self.llm = llm
+        self.llm_with_tools = llm.bind_tools(tools=get_tools())
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.seconds = 0.0
+        self.reasons: Dict[str, int] = {}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.spec,
+            "calls": self.calls,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "seconds": round(self.seconds, 3),
+            "reasons": dict(self.reasons),
+        }
+
+@built_once
+def get_model_routes(fast_spec: str = FAST_MODEL, strong_spec: str = STRONG_MODEL) -> Dict[str, ModelRoute]:
+    """Routes for the configured models; replace an entry (e.g. ModelRoute("fast", fake_llm)) to inject a model"""
+    fast = create_llm(fast_spec)
+    strong = fast if strong_spec == fast_spec else create_llm(strong_spec)
+    return {"fast": ModelRoute("fast", fast, fast_spec), "strong": ModelRoute("strong", strong, strong_spec)}
+STRUCTURE_PATTERN = re.compile(ROUTE_STRONG_STRUCTURE, re.IGNORECASE)
+
+def choose_route(messages: list, prompt: list) -> tuple:
+    """Pick the route for a model call from the turn's request and the assembled prompt.
+
+    Returns (route name, reason).
+    """
+    request = next((message for message in reversed(messages) if isinstance(message, HumanMessage)), None)
+    text = request.content if request is not None and isinstance(request.content, str) else ""
+    if len(text) >= ROUTE_STRONG_MIN_REQUEST_CHARS:
+        return "strong", "request_length"
+    if count_tokens_approximately(prompt) >= ROUTE_STRONG_MIN_PROMPT_TOKENS:
+        return "strong", "prompt_tokens"
+    if STRUCTURE_PATTERN.search(text):
+        return "strong", "structure"
+    return "fast", "default"
 
 SYSTEM_MESSAGE = SystemMessage(content="""
 You are Notion AI, a smart and flexible content assistant inside a Notion-like workspace. Your job is to help users generate **any type of content** — documents, code, guides, lists, strategies, summaries, or creative writing — depending on the user's intent.
@@ -83,8 +1088,191 @@ Default structure when the user doesn't specify:
 ---
 """)
 
+# Line patterns, compiled once and shared by every parser instance
+HEADING_PATTERN = re.compile(r'(#{1,6})\s+(.+)')
+BULLET_PATTERN = re.compile(r'[-*+]\s+(.+)')
+NUMBER_PATTERN = re.compile(r'(\d+)\.\s+(.+)')
+DIVIDER_PATTERN = re.compile(r'-{3,}$|\*{3,}$|_{3,}$')
+FORMATTING_PATTERN = re.compile(r'\*\*[^*]+\*\*|\*[^*]+\*|`[^`]+`|~~[^~]+~~')
+LINK_PATTERN = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+IMAGE_PATTERN = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+ITALIC_PATTERN = re.compile(r'\*[^*]+\*(?!\*)')
+LIST_PATTERN = re.compile(r'^[\s]*[-*+]\s|^[\s]*\d+\.\s', re.MULTILINE)
+# Line prefixes (after leading whitespace) whose block type can still change before the newline:
+# code fences and table rows, bare heading/list/quote markers, divider runs and bare numbers
+TABLE_ALIGNMENT_PATTERN = re.compile(r':?-+:?$')
+UNSETTLED_PREFIX_PATTERN = re.compile(r'[`|]|#{1,6}\s*$|[-*+]\s*$|([-*_])\1*\s*$|\d+\.?\s*$|>\s*$')
+
+# Code fence markers -> language names
+LANGUAGE_MAP = {
+    'py': 'python', 'python': 'python',
+    'js': 'javascript', 'javascript': 'javascript',
+    'ts': 'typescript', 'typescript': 'typescript',
+    'jsx': 'javascript', 'tsx': 'typescript',
+    'html': 'html', 'htm': 'html',
+    'css': 'css', 'scss': 'scss', 'sass': 'sass',
+    'sql': 'sql', 'mysql': 'sql', 'postgresql': 'sql',
+    'json': 'json', 'yaml': 'yaml', 'yml': 'yaml',
+    'xml': 'xml', 'md': 'markdown', 'markdown': 'markdown',
+    'sh': 'bash', 'bash': 'bash', 'zsh': 'bash',
+    'r': 'r', 'go': 'go', 'rust': 'rust', 'rs': 'rust',
+    'java': 'java', 'c': 'c', 'cpp': 'cpp', 'c++': 'cpp',
+    'cs': 'csharp', 'csharp': 'csharp', 'c#': 'csharp',
+    'php': 'php', 'rb': 'ruby', 'ruby': 'ruby',
+    'swift': 'swift', 'kt': 'kotlin', 'kotlin': 'kotlin',
+    'dart': 'dart', 'scala': 'scala', 'clj': 'clojure'
+}
+EXECUTABLE_LANGUAGES = frozenset(('python', 'javascript', 'sql'))
+
+class ContentMetadata:
+    """Per-line content analysis; slots instead of a dict, as it is built for every line"""
+    __slots__ = (
+        'word_count', 'char_count', 'line_count', 'has_formatting', 'has_links', 'has_inline_code',
+        'has_images', 'has_bold', 'has_italic', 'has_strikethrough', 'has_lists', 'has_tables',
+        'has_quotes', 'language',
+    )
+    
+    def __init__(
+        self, word_count, char_count, line_count, has_formatting, has_links, has_inline_code,
+        has_images, has_bold, has_italic, has_strikethrough, has_lists, has_tables, has_quotes, language=None,
+    ):
+        self.word_count = word_count
+        self.char_count = char_count
+        self.line_count = line_count
+        self.has_formatting = has_formatting
+        self.has_links = has_links
+        self.has_inline_code = has_inline_code
+        self.has_images = has_images
+        self.has_bold = has_bold
+        self.has_italic = has_italic
+        self.has_strikethrough = has_strikethrough
+        self.has_lists = has_lists
+        self.has_tables = has_tables
+        self.has_quotes = has_quotes
+        self.language = language
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class ParserEvent:
+    """Parser event record. Records stay objects through the parser and the stream loop
+    and are turned into dicts only at the edge, via each record's to_dict(): when encoded
+    or stored with the thread."""
+    __slots__ = ()
+    type = ''
+
+class ContentEvent(ParserEvent):
+    __slots__ = ('content', 'content_type', 'metadata', 'in_code_block', 'code_language', 'in_table', 'block_type', 'streamed')
+    type = 'content'
+    
+    def __init__(self, content, content_type, metadata, in_code_block, code_language, in_table, block_type, streamed=False):
+        self.content = content
+        self.content_type = content_type
+        self.metadata = metadata
+        self.in_code_block = in_code_block
+        self.code_language = code_language
+        self.in_table = in_table
+        self.block_type = block_type
+        self.streamed = streamed
+    
+    @classmethod
+    def from_dict(cls, event: Dict[str, Any]) -> 'ContentEvent':
+        """Rebuild a record from its stored dict form"""
+        context = event['context']
+        return cls(
+            event['content'], event['content_type'], ContentMetadata(**event['metadata']),
+            context['in_code_block'], context['code_language'], context['in_table'], context['block_type'],
+            event.get('streamed', False),
+        )
+    
+    def to_dict(self) -> Dict[str, Any]:
+        event = {
+            'type': 'content',
+            'content': self.content,
+            'content_type': self.content_type,
+            'metadata': self.metadata.to_dict(),
+            'context': {
+                'in_code_block': self.in_code_block,
+                'code_language': self.code_language,
+                'in_table': self.in_table,
+                'block_type': self.block_type
+            }
+        }
+        if self.streamed:
+            event['streamed'] = True
+        return event
+
+class ContentDeltaEvent(ParserEvent):
+    __slots__ = ('content', 'block_id')
+    type = 'content_delta'
+    
+    def __init__(self, content, block_id):
+        self.content = content
+        self.block_id = block_id
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {'type': 'content_delta', 'content': self.content, 'block_id': self.block_id}
+
+class BlockStartEvent(ParserEvent):
+    __slots__ = ('block_info',)
+    type = 'block_start'
+    
+    def __init__(self, block_info):
+        self.block_info = block_info
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {'type': 'block_start', 'block_info': self.block_info}
+
+class BlockEndEvent(ParserEvent):
+    # content is only set when a grouped code block ends
+    __slots__ = ('block_id', 'content')
+    type = 'block_end'
+    
+    def __init__(self, block_id, content=None):
+        self.block_id = block_id
+        self.content = content
+    
+    def to_dict(self) -> Dict[str, Any]:
+        event = {'type': 'block_end', 'block_id': self.block_id}
+        if self.content is not None:
+            event['content'] = self.content
+        return event
+
+class BlockAppendEvent(ParserEvent):
+    __slots__ = ('block_id', 'op', 'value')
+    type = 'block_append'
+    
+    def __init__(self, block_id, op, value):
+        self.block_id = block_id
+        self.op = op
+        self.value = value
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {'type': 'block_append', 'block_id': self.block_id, 'op': self.op, 'value': self.value}
+
+class LineBreakEvent(ParserEvent):
+    __slots__ = ()
+    type = 'line_break'
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {'type': 'line_break'}
+
+# Line breaks carry no state, so every parser shares one record
+LINE_BREAK_EVENT = LineBreakEvent()
+
+def event_dict(event: Any) -> Any:
+    """Dict form of a parser event; dicts (summaries, stored blocks) pass through"""
+    return event.to_dict() if isinstance(event, ParserEvent) else event
+
 class EnhancedStreamingContentParser:
-    def __init__(self):
+    def __init__(self, incremental: bool = False, grouped: bool = False):
+        # Incremental mode streams partial lines as content_delta events
+        self.incremental = incremental
+        # Grouped mode sends tables, lists and code as single blocks built with block_append
+        self.grouped = grouped
+        self.code_lines = []
+        self.partial_committed = False
+        self.partial_sent = 0
         self.content_buffer = ""
         self.current_block = None
         self.block_id_counter = 0
@@ -94,78 +1282,154 @@ class EnhancedStreamingContentParser:
         self.table_headers = []
         self.current_list_type = None
         self.current_list_items = []
-        self.processed_lines = []
+        # One random prefix per run; block IDs only add the counter to it
+        self.block_id_prefix = uuid4().hex[:8]
+        # Summary stats, kept up to date as lines are processed
+        self.total_words = 0
+        self.total_chars = 0
+        self.content_types = {}
+        self.had_code_blocks = False
+        self.had_tables = False
         
     def generate_block_id(self) -> str:
         """Generate unique block ID"""
         self.block_id_counter += 1
-        return f"block_{self.block_id_counter}_{str(uuid4())[:8]}"
+        return f"block_{self.block_id_counter}_{self.block_id_prefix}"
     
     def detect_language(self, marker: str) -> str:
         """Enhanced language detection"""
-        language_map = {
-            'py': 'python', 'python': 'python',
-            'js': 'javascript', 'javascript': 'javascript',
-            'ts': 'typescript', 'typescript': 'typescript',
-            'jsx': 'javascript', 'tsx': 'typescript',
-            'html': 'html', 'htm': 'html',
-            'css': 'css', 'scss': 'scss', 'sass': 'sass',
-            'sql': 'sql', 'mysql': 'sql', 'postgresql': 'sql',
-            'json': 'json', 'yaml': 'yaml', 'yml': 'yaml',
-            'xml': 'xml', 'md': 'markdown', 'markdown': 'markdown',
-            'sh': 'bash', 'bash': 'bash', 'zsh': 'bash',
-            'r': 'r', 'go': 'go', 'rust': 'rust', 'rs': 'rust',
-            'java': 'java', 'c': 'c', 'cpp': 'cpp', 'c++': 'cpp',
-            'cs': 'csharp', 'csharp': 'csharp', 'c#': 'csharp',
-            'php': 'php', 'rb': 'ruby', 'ruby': 'ruby',
-            'swift': 'swift', 'kt': 'kotlin', 'kotlin': 'kotlin',
-            'dart': 'dart', 'scala': 'scala', 'clj': 'clojure'
-        }
-        return language_map.get(marker.lower().strip(), marker.lower().strip() if marker else 'text')
+        marker = marker.lower().strip()
+        return LANGUAGE_MAP.get(marker, marker or 'text')
     
-    def analyze_content_metadata(self, content: str) -> Dict[str, Any]:
+    def analyze_content_metadata(self, content: str) -> ContentMetadata:
         """Enhanced content analysis"""
-        words = content.split()
-        metadata = {
-            'word_count': len(words),
-            'char_count': len(content),
-            'line_count': content.count('\n') + 1,
-            'has_formatting': bool(re.search(r'\*\*[^*]+\*\*|\*[^*]+\*|`[^`]+`|~~[^~]+~~', content)),
-            'has_links': bool(re.search(r'\[([^\]]+)\]\(([^)]+)\)', content)),
-            'has_inline_code': '`' in content and not content.strip().startswith('```'),
-            'has_images': bool(re.search(r'!\[([^\]]*)\]\(([^)]+)\)', content)),
-            'has_bold': '**' in content,
-            'has_italic': re.search(r'\*[^*]+\*(?!\*)', content) is not None,
-            'has_strikethrough': '~~' in content,
-            'has_lists': bool(re.search(r'^[\s]*[-*+]\s|^[\s]*\d+\.\s', content, re.MULTILINE)),
-            'has_tables': '|' in content and content.count('|') >= 2,
-            'has_quotes': content.strip().startswith('>'),
-            'language': None
-        }
-        
-        if self.in_code_block and self.code_language:
-            metadata['language'] = self.code_language
-            
-        return metadata
+        stripped = content.strip()
+        has_star = '*' in content
+        has_backtick = '`' in content
+        has_strikethrough = '~~' in content
+        # Only run a pattern when the characters it needs are present
+        has_link_syntax = '](' in content
+        return ContentMetadata(
+            word_count=len(content.split()),
+            char_count=len(content),
+            line_count=content.count('\n') + 1,
+            has_formatting=(has_star or has_backtick or has_strikethrough) and FORMATTING_PATTERN.search(content) is not None,
+            has_links=has_link_syntax and LINK_PATTERN.search(content) is not None,
+            has_inline_code=has_backtick and not stripped.startswith('```'),
+            has_images=has_link_syntax and '![' in content and IMAGE_PATTERN.search(content) is not None,
+            has_bold=has_star and '**' in content,
+            has_italic=has_star and ITALIC_PATTERN.search(content) is not None,
+            has_strikethrough=has_strikethrough,
+            has_lists=LIST_PATTERN.search(content) is not None,
+            has_tables=content.count('|') >= 2,
+            has_quotes=stripped.startswith('>'),
+            language=self.code_language if self.in_code_block and self.code_language else None
+        )
     
-    def classify_content_type(self, content: str) -> ContentType:
-        """Classify content type for rendering"""
+    def classify_content_type(self, content: str, metadata: Optional[ContentMetadata] = None) -> ContentType:
+        """Classify content type for rendering, reusing metadata when already computed"""
         if self.in_code_block:
             return ContentType.CODE
         
-        metadata = self.analyze_content_metadata(content)
+        if metadata is None:
+            metadata = self.analyze_content_metadata(content)
         
-        if metadata['has_inline_code']:
+        if metadata.has_inline_code:
             return ContentType.TEXT_WITH_CODE
-        elif metadata['has_formatting']:
+        elif metadata.has_formatting:
             return ContentType.TEXT_WITH_FORMATTING
-        elif metadata['has_links']:
+        elif metadata.has_links:
             return ContentType.TEXT_WITH_LINKS
-        elif any([metadata['has_lists'], metadata['has_tables'], metadata['has_quotes']]):
+        elif metadata.has_lists or metadata.has_tables or metadata.has_quotes:
             return ContentType.MARKDOWN
         else:
             return ContentType.PLAIN_TEXT
     
+    def _detect_heading(self, stripped: str) -> Optional[Dict[str, Any]]:
+        heading_match = HEADING_PATTERN.match(stripped)
+        if not heading_match:
+            return None
+        level = len(heading_match.group(1))
+        content = heading_match.group(2).strip()
+        return {
+            'type': f"heading_{level}",
+            'content': content,
+            'block_id': self.generate_block_id(),
+            'metadata': {
+                'level': level,
+                'text': content
+            }
+        }
+    
+    def _detect_bullet_or_divider(self, stripped: str) -> Optional[Dict[str, Any]]:
+        bullet_match = BULLET_PATTERN.match(stripped)
+        if bullet_match:
+            content = bullet_match.group(1).strip()
+            return {
+                'type': BlockType.BULLETED_LIST.value,
+                'content': content,
+                'block_id': self.generate_block_id(),
+                'metadata': {
+                    'list_type': 'bulleted',
+                    'text': content,
+                    'marker': stripped[0]
+                }
+            }
+        return self._detect_divider(stripped)
+    
+    def _detect_numbered(self, stripped: str) -> Optional[Dict[str, Any]]:
+        number_match = NUMBER_PATTERN.match(stripped)
+        if not number_match:
+            return None
+        number = int(number_match.group(1))
+        content = number_match.group(2).strip()
+        return {
+            'type': BlockType.NUMBERED_LIST.value,
+            'content': content,
+            'block_id': self.generate_block_id(),
+            'metadata': {
+                'list_type': 'numbered',
+                'number': number,
+                'text': content
+            }
+        }
+    
+    def _detect_quote(self, stripped: str) -> Optional[Dict[str, Any]]:
+        if not stripped.startswith('> '):
+            return None
+        content = stripped[2:].strip()
+        return {
+            'type': BlockType.QUOTE.value,
+            'content': content,
+            'block_id': self.generate_block_id(),
+            'metadata': {
+                'quote_style': 'default',
+                'text': content
+            }
+        }
+    
+    def _detect_divider(self, stripped: str) -> Optional[Dict[str, Any]]:
+        if not DIVIDER_PATTERN.match(stripped):
+            return None
+        return {
+            'type': BlockType.DIVIDER.value,
+            'block_id': self.generate_block_id(),
+            'metadata': {
+                'style': 'line'
+            }
+        }
+    
+    # First character of a stripped line -> the only detector that can match it
+    _BLOCK_DETECTORS = {
+        '#': _detect_heading,
+        '-': _detect_bullet_or_divider,
+        '*': _detect_bullet_or_divider,
+        '+': _detect_bullet_or_divider,
+        '>': _detect_quote,
+        '_': _detect_divider,
+        **dict.fromkeys('0123456789', _detect_numbered),
+    }
+    
     def detect_block_type(self, line: str) -> Optional[Dict[str, Any]]:
         """Enhanced block type detection"""
         stripped = line.strip()
@@ -186,6 +1450,7 @@ class EnhancedStreamingContentParser:
             else:
                 # Start of code block
                 self.in_code_block = True
+                self.had_code_blocks = True
                 language = stripped[3:].strip()
                 self.code_language = self.detect_language(language)
                 return {
@@ -196,7 +1461,7 @@ class EnhancedStreamingContentParser:
                     'metadata': {
                         'language': self.code_language,
                         'syntax_highlighting': True,
-                        'executable': self.code_language in ['python', 'javascript', 'sql']
+                        'executable': self.code_language in EXECUTABLE_LANGUAGES
                     }
                 }
         
@@ -204,79 +1469,19 @@ class EnhancedStreamingContentParser:
         if self.in_code_block:
             return None
         
-        # Headings (H1-H6)
-        heading_match = re.match(r'^(#{1,6})\s+(.+)', stripped)
-        if heading_match:
-            level = len(heading_match.group(1))
-            content = heading_match.group(2).strip()
-            return {
-                'type': f"heading_{level}",
-                'content': content,
-                'block_id': self.generate_block_id(),
-                'metadata': {
-                    'level': level,
-                    'text': content
-                }
-            }
-        
-        # Lists
-        bullet_match = re.match(r'^[\s]*[-*+]\s+(.+)', stripped)
-        if bullet_match:
-            content = bullet_match.group(1).strip()
-            return {
-                'type': BlockType.BULLETED_LIST.value,
-                'content': content,
-                'block_id': self.generate_block_id(),
-                'metadata': {
-                    'list_type': 'bulleted',
-                    'text': content,
-                    'marker': stripped[0] if stripped[0] in '-*+' else '-'
-                }
-            }
-        
-        number_match = re.match(r'^[\s]*(\d+)\.\s+(.+)', stripped)
-        if number_match:
-            number = int(number_match.group(1))
-            content = number_match.group(2).strip()
-            return {
-                'type': BlockType.NUMBERED_LIST.value,
-                'content': content,
-                'block_id': self.generate_block_id(),
-                'metadata': {
-                    'list_type': 'numbered',
-                    'number': number,
-                    'text': content
-                }
-            }
-        
-        # Quotes
-        if stripped.startswith('> '):
-            content = stripped[2:].strip()
-            return {
-                'type': BlockType.QUOTE.value,
-                'content': content,
-                'block_id': self.generate_block_id(),
-                'metadata': {
-                    'quote_style': 'default',
-                    'text': content
-                }
-            }
-        
-        # Dividers
-        if re.match(r'^-{3,}$|^\*{3,}$|^_{3,}$', stripped):
-            return {
-                'type': BlockType.DIVIDER.value,
-                'block_id': self.generate_block_id(),
-                'metadata': {
-                    'style': 'line'
-                }
-            }
+        # Headings, lists, quotes and dividers
+        detector = self._BLOCK_DETECTORS.get(stripped[0])
+        if detector is not None:
+            block_info = detector(self, stripped)
+            if block_info is not None:
+                return block_info
         
         # Tables
-        if stripped.startswith('|') and stripped.endswith('|') and stripped.count('|') >= 2:
+        if stripped[0] == '|' and stripped[-1] == '|' and len(stripped) >= 2:
             cells = [cell.strip() for cell in stripped[1:-1].split('|')]
             if not self.in_table:
                 self.in_table = True
+                self.had_tables = True
                 self.table_headers = cells
                 return {
                     'type': BlockType.TABLE.value,
@@ -306,19 +1511,16 @@ class EnhancedStreamingContentParser:
                 self.table_headers = []
         
         # Default paragraph
-        if stripped:
-            return {
-                'type': BlockType.PARAGRAPH.value,
-                'content': stripped,
-                'block_id': self.generate_block_id(),
-                'metadata': {
-                    'text': stripped
-                }
+        return {
+            'type': BlockType.PARAGRAPH.value,
+            'content': stripped,
+            'block_id': self.generate_block_id(),
+            'metadata': {
+                'text': stripped
             }
-        
-        return None
+        }
     
-    def process_content_chunk(self, chunk: str) -> List[Dict[str, Any]]:
+    def process_content_chunk(self, chunk: str) -> List[ParserEvent]:
         """Process content chunk and return structured blocks"""
         events = []
         self.content_buffer += chunk
@@ -329,91 +1531,423 @@ class EnhancedStreamingContentParser:
             self.content_buffer = lines[-1]  # Keep incomplete line
             
             for line in lines[:-1]:
-                events.extend(self.process_line(line))
+                events.extend(self.process_line(line, streamed=self.partial_committed))
+                self.partial_committed = False
+                self.partial_sent = 0
             
             # Send line break for empty lines
             if not lines[-2].strip():  # Check second to last line
-                events.append({'type': 'line_break'})
+                events.append(LINE_BREAK_EVENT)
+        
+        if self.incremental and self.content_buffer:
+            events.extend(self.process_partial_line())
         
         return events
     
-    def process_line(self, line: str) -> List[Dict[str, Any]]:
-        """Process a single line and return events"""
+    def process_partial_line(self) -> List[ParserEvent]:
+        """Stream the incomplete last line once its prefix settles the block type"""
         events = []
+        partial = self.content_buffer
+        
+        if not self.partial_committed:
+            stripped = partial.lstrip()
+            if not stripped:
+                return events
+            if self.in_code_block:
+                # A backtick may still turn into the closing fence
+                if stripped[0] == '`':
+                    return events
+            elif UNSETTLED_PREFIX_PATTERN.match(stripped):
+                return events
+            if self.grouped and (self.in_code_block or BULLET_PATTERN.match(stripped) or NUMBER_PATTERN.match(stripped)):
+                # Grouped blocks are appended to one whole line at a time
+                return events
+            for event in self.block_events(partial):
+                if isinstance(event, BlockStartEvent):
+                    # Only a prefix of the line's text is known yet; it follows as content_delta
+                    # events and then in full with the line's content event
+                    event.block_info.pop('content', None)
+                    event.block_info.get('metadata', {}).pop('text', None)
+                events.append(event)
+            self.partial_committed = True
         
-        # Detect block type
-        block_info = self.detect_block_type(line)
+        if len(partial) > self.partial_sent:
+            events.append(ContentDeltaEvent(
+                partial[self.partial_sent:],
+                self.current_block.get('block_id') if self.current_block else None
+            ))
+            self.partial_sent = len(partial)
+        
+        return events
+    
+    def process_line(self, line: str, streamed: bool = False) -> List[ParserEvent]:
+        """Process a single line and return events.
+
+        A streamed line already opened its block and sent its text as content_delta events;
+        its content event is still sent with the full line and metadata, marked `streamed`.
+        """
+        block_info = None if streamed else self.detect_block_type(line)
+        
+        # Content is any non-empty line but an opening fence. It counts towards the end
+        # summary in every mode, grouped lines included.
+        stripped = line.strip()
+        is_content = bool(stripped) and not (stripped.startswith('```') and not self.in_code_block)
+        if is_content:
+            # Analyse once; the same metadata drives classification and the event
+            content_metadata = self.analyze_content_metadata(line)
+            content_type = self.classify_content_type(line, content_metadata).value
+            self.total_words += content_metadata.word_count
+            self.total_chars += content_metadata.char_count
+            self.content_types[content_type] = True
+        
+        if streamed:
+            events = []
+        else:
+            if self.grouped:
+                group_events = self.group_events(line, block_info)
+                if group_events is not None:
+                    return group_events
+            events = self.open_block(block_info)
+        
+        if is_content:
+            events.append(ContentEvent(
+                line,
+                content_type,
+                content_metadata,
+                self.in_code_block,
+                self.code_language,
+                self.in_table,
+                self.current_block.get('type', 'paragraph') if self.current_block else 'paragraph',  # FIXED: Safe access
+                streamed
+            ))
+        
+        return events
+    
+    def block_events(self, line: str) -> List[ParserEvent]:
+        """Detect the block a line starts and return the block_end/block_start events for it"""
+        return self.open_block(self.detect_block_type(line))
+    
+    def open_block(self, block_info: Optional[Dict[str, Any]]) -> List[ParserEvent]:
+        events = []
         
         if block_info:
             # End previous block if needed
             if self.current_block and block_info.get('action') != 'end':
-                events.append({
-                    'type': 'block_end',
-                    'block_id': self.current_block.get('block_id', 'unknown_block')  # FIXED: Safe access
-                })
+                events.append(BlockEndEvent(self.current_block.get('block_id', 'unknown_block')))  # FIXED: Safe access
             
             # Send block start event
             if block_info.get('action') != 'end':
-                events.append({
-                    'type': 'block_start',
-                    'block_info': block_info
-                })
+                events.append(BlockStartEvent(block_info))
                 self.current_block = block_info
             else:
                 self.current_block = None
         
-        # Send content if not empty and not a block marker
-        if line.strip() and not (line.strip().startswith('```') and not self.in_code_block):
-            content_type = self.classify_content_type(line)
-            content_metadata = self.analyze_content_metadata(line)
-            
-            events.append({
-                'type': 'content',
-                'content': line,
-                'content_type': content_type.value,
-                'metadata': content_metadata,
-                'context': {
-                    'in_code_block': self.in_code_block,
-                    'code_language': self.code_language,
-                    'in_table': self.in_table,
-                    'block_type': self.current_block.get('type', 'paragraph') if self.current_block else 'paragraph'  # FIXED: Safe access
+        return events
+    
+    def append_event(self, op: str, value: Any) -> BlockAppendEvent:
+        return BlockAppendEvent(self.current_block['block_id'], op, value)
+    
+    def group_events(self, line: str, block_info: Optional[Dict[str, Any]]) -> Optional[List[ParserEvent]]:
+        """Fold table rows, list items and code lines into one block per group.
+
+        Returns None for lines that are not part of a group, so they take the regular path.
+        """
+        if block_info is None:
+            if not (self.in_code_block and self.current_block):
+                return None
+            # Code body, blank lines included
+            self.code_lines.append(line)
+            return [self.append_event('line', line)]
+        
+        action = block_info.get('action')
+        if action == 'start':
+            self.code_lines = []
+            return self.open_block(block_info)
+        if action == 'end':
+            events = []
+            if self.current_block:
+                events.append(BlockEndEvent(self.current_block['block_id'], '\n'.join(self.code_lines)))
+            self.current_block = None
+            self.code_lines = []
+            return events
+        
+        block_type = block_info['type']
+        
+        if block_type == BlockType.TABLE.value:
+            cells = block_info['content']
+            if self.current_block and self.current_block['type'] == 'table_group':
+                if all(TABLE_ALIGNMENT_PATTERN.match(cell) for cell in cells):
+                    return []
+                return [self.append_event('row', cells)]
+            # A header, or a row left over from a table interrupted by another block
+            self.table_headers = cells
+            return self.open_block({
+                'type': 'table_group',
+                'block_id': block_info.get('block_id') or self.generate_block_id(),
+                'metadata': {
+                    'headers': cells,
+                    'column_count': len(cells)
                 }
             })
         
-        return events
+        if block_type in (BlockType.BULLETED_LIST.value, BlockType.NUMBERED_LIST.value):
+            list_type = block_info['metadata']['list_type']
+            item = {'content': block_info['content']}
+            if 'number' in block_info['metadata']:
+                item['number'] = block_info['metadata']['number']
+            
+            events = []
+            current = self.current_block
+            if not (current and current['type'] == 'list_group' and self.current_list_type == list_type):
+                events.extend(self.open_block({
+                    'type': 'list_group',
+                    'block_id': block_info['block_id'],
+                    'metadata': {
+                        'list_type': list_type
+                    }
+                }))
+                self.current_list_type = list_type
+                self.current_list_items = []
+            self.current_list_items.append(item)
+            events.append(self.append_event('item', item))
+            return events
+        
+        return None
     
-    def finalize(self) -> List[Dict[str, Any]]:
+    def finalize(self) -> List[Any]:
         """Process any remaining content and return final events"""
         events = []
         
         if self.content_buffer.strip():
-            events.extend(self.process_line(self.content_buffer))
+            events.extend(self.process_line(self.content_buffer, streamed=self.partial_committed))
+        self.content_buffer = ""
+        self.partial_committed = False
+        self.partial_sent = 0
         
         # End any open blocks
         if self.current_block:
-            events.append({
-                'type': 'block_end',
-                'block_id': self.current_block['block_id']
-            })
+            events.append(BlockEndEvent(self.current_block.get('block_id', 'unknown_block')))
         
-        # Generate summary
+        # Summary of everything parsed so far, from the running stats
         events.append({
             'type': 'end',
             'summary': {
                 'total_blocks': self.block_id_counter,
-                'content_types': list(set([event.get('content_type') for event in events if event.get('content_type')])),
-                'had_code_blocks': any(event.get('block_info', {}).get('type') == BlockType.CODE_BLOCK.value for event in events),
-                'had_tables': self.in_table or bool(self.table_headers),
-                'total_words': sum(event.get('metadata', {}).get('word_count', 0) for event in events),
-                'total_chars': sum(event.get('metadata', {}).get('char_count', 0) for event in events)
+                'content_types': list(self.content_types),
+                'had_code_blocks': self.had_code_blocks,
+                'had_tables': self.had_tables,
+                'total_words': self.total_words,
+                'total_chars': self.total_chars
             }
         })
         
         return events
 
-async def model(state: State):
-    result = await llm_with_tools.ainvoke(state["messages"])
-    return {"messages": [result]}
+# Tag on internal LLM calls whose stream events must not reach the client
+SUMMARY_TAG = "history_summary"
+
+SUMMARY_PROMPT = """Extend the running summary of this conversation with the messages below. \
+Keep facts, decisions, user preferences and open questions. Reply with the summary only.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}"""
+
+def build_system_message(summary: str) -> SystemMessage:
+    if not summary:
+        return SYSTEM_MESSAGE
+    return SystemMessage(content=f"{SYSTEM_MESSAGE.content}\nSummary of the earlier conversation:\n{summary}\n")
+
+async def summarize_history(summary: str, messages: list) -> str:
+    """Fold messages into the rolling summary"""
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none)", messages=get_buffer_string(messages))
+    result = await invoke_model(get_model_routes()["fast"].llm, [HumanMessage(content=prompt)], config={"tags": [SUMMARY_TAG]})
+    return result.content
+
+async def assemble_prompt(state: State):
+    """Build the model input: one system prompt plus as much recent history as fits the budget.
+
+    Returns the prompt and the state updates that go with it (removed messages, new summary).
+    """
+    summary = state.get("summary", "")
+    # Threads from before prompt assembly stored a system prompt on every turn
+    legacy_system = [message for message in state["messages"] if isinstance(message, SystemMessage)]
+    history = [message for message in state["messages"] if not isinstance(message, SystemMessage)]
+    updates: Dict[str, Any] = {"messages": [RemoveMessage(id=message.id) for message in legacy_system]}
+    
+    system_message = build_system_message(summary)
+    budget = HISTORY_MAX_TOKENS - count_tokens_approximately([system_message])
+    kept = trim_messages(
+        history,
+        max_tokens=budget,
+        token_counter=count_tokens_approximately,
+        strategy="last",
+        start_on="human",
+    )
+    if not kept:
+        # The current turn alone is over budget; send it whole rather than nothing
+        last_human = max((i for i, message in enumerate(history) if isinstance(message, HumanMessage)), default=0)
+        kept = history[last_human:]
+    
+    dropped = history[:len(history) - len(kept)]
+    if dropped and HISTORY_SUMMARIZE:
+        folded = await summarize_history(summary, dropped)
+        # Without a summary to replace them the dropped turns stay in state, out of this prompt
+        if folded.strip():
+            summary = folded
+            system_message = build_system_message(summary)
+            updates["summary"] = summary
+            updates["messages"].extend(RemoveMessage(id=message.id) for message in dropped)
+    
+    return [system_message, *kept], updates
+
+class CachedChatModel(BaseChatModel):
+    """Replays a cached response through the regular chat model callbacks.
+
+    Streaming it line by line produces the same on_chat_model_stream/on_chat_model_end
+    events as a live call, so cached answers go through the normal SSE block pipeline.
+    """
+
+    message: AIMessage
+
+    @property
+    def _llm_type(self) -> str:
+        return "cached"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=self.message)])
+
+    def _chunks(self):
+        for line in self.message.content.splitlines(keepends=True):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=line))
+        if self.message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                tool_call_chunk(name=call["name"], args=json.dumps(call["args"]), id=call["id"], index=index)
+                for index, call in enumerate(self.message.tool_calls)
+            ]))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._chunks():
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._chunks():
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+def response_cache_key(prompt: list, model_spec: str = "") -> str:
+    """Key on exact message content: case and inner whitespace (code, tables) change the answer"""
+    return cache_key(model_spec, [
+        (message.type, message.content.strip() if isinstance(message.content, str) else message.content,
+         getattr(message, "tool_calls", None), getattr(message, "tool_call_id", None))
+        for message in prompt
+    ])
+
+FRESH_DATA_PATTERN = re.compile(
+    r'\b(latest|newest|recent(ly)?|today|tonight|yesterday|tomorrow|this (week|month|year)|current(ly)?|right now|'
+    r'news|headlines?|updates?|prices?|stocks?|weather|scores?|results?|released?|announced?|who won|look up|search|20[2-9]\d)\b',
+    re.IGNORECASE,
+)
+# Arguments the model may fill in without changing what a plain query returns
+NEUTRAL_SEARCH_ARGS = {"topic": "general", "search_depth": "basic"}
+
+# In-flight speculative searches by thread id: (query, task)
+search_prefetches: Dict[Any, tuple] = {}
+
+def prefetch_query(message) -> Optional[str]:
+    """Search query to speculate on for this message, if it looks like it needs fresh data"""
+    if not isinstance(message, HumanMessage) or not isinstance(message.content, str):
+        return None
+    if not FRESH_DATA_PATTERN.search(message.content):
+        return None
+    # Tavily rejects queries over 400 characters
+    return " ".join(message.content.split())[:400]
+
+def query_terms(text: str) -> set:
+    return set(re.findall(r'\w+', text.lower()))
+
+def query_overlap(a: str, b: str) -> float:
+    a_terms = query_terms(a)
+    b_terms = query_terms(b)
+    union = a_terms | b_terms
+    return len(a_terms & b_terms) / len(union) if union else 0.0
+
+def start_search_prefetch(state: State, config) -> None:
+    thread_id = config.get("configurable", {}).get("thread_id")
+    discard_search_prefetch(thread_id)
+    query = prefetch_query(state["messages"][-1])
+    # Speculation only uses idle search capacity; it never queues behind real searches
+    if query is None or search_limiter.active >= search_limiter.limit:
+        return
+    search_prefetches[thread_id] = (query, asyncio.ensure_future(get_search_tool()._arun(query)))
+
+def discard_search_prefetch(thread_id) -> None:
+    entry = search_prefetches.pop(thread_id, None)
+    if entry is not None:
+        entry[1].cancel()
+
+def claim_search_prefetch(thread_id, args: Dict[str, Any]):
+    """Take the thread's prefetched search task if it answers this search call"""
+    entry = search_prefetches.get(thread_id)
+    if entry is None:
+        return None
+    query, task = entry
+    extra = {
+        name: value for name, value in args.items()
+        if name != "query" and value not in (None, "", [], False) and NEUTRAL_SEARCH_ARGS.get(name) != value
+    }
+    if extra or query_overlap(query, args.get("query", "")) < SEARCH_PREFETCH_MIN_OVERLAP:
+        return None
+    del search_prefetches[thread_id]
+    return task
+
+async def model(state: State, config):
+    thread_id = config.get("configurable", {}).get("thread_id")
+    # Routes and their tools, built in a worker thread if warm-up has not got there yet
+    await get_model_routes.abuild()
+    if SEARCH_PREFETCH:
+        start_search_prefetch(state, config)
+    try:
+        updates = await call_model(state)
+    except BaseException:
+        # A failed or cancelled run never reaches tool_node to claim the prefetch
+        discard_search_prefetch(thread_id)
+        raise
+    if not any(call["name"] == SEARCH_TOOL_NAME for call in updates["messages"][-1].tool_calls):
+        discard_search_prefetch(thread_id)
+    return updates
+
+async def call_model(state: State):
+    """Route, answer from the response cache or call the model; returns the state updates"""
+    prompt, updates = await assemble_prompt(state)
+    route_name, reason = choose_route(state["messages"], prompt)
+    route = get_model_routes()[route_name]
+    route.reasons[reason] = route.reasons.get(reason, 0) + 1
+    key = response_cache_key(prompt, route.spec)
+    cached = await response_cache.aget(key)
+    if cached is not None:
+        route.cache_hits += 1
+        result = await CachedChatModel(message=cached).ainvoke(prompt)
+    else:
+        started = time.perf_counter()
+        route.calls += 1
+        try:
+            result = await invoke_model(route.llm_with_tools, prompt)
+        except Exception:
+            route.errors += 1
+            raise
+        finally:
+            route.seconds += time.perf_counter() - started
+        if isinstance(result.content, str):
+            # Store without the run id so each replay gets a fresh message id
+            await response_cache.aset(key, AIMessage(content=result.content, tool_calls=result.tool_calls))
+    updates["messages"].append(result)
+    return updates
 
 async def tools_router(state: State):
     last_message = state["messages"][-1]
@@ -422,11 +1956,173 @@ async def tools_router(state: State):
     else: 
         return END
 
-tool_node = ToolNode(tools=tools)
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), parts.query, ""))
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+def url_domain(url: str) -> str:
+    domain = urlsplit(url.strip()).netloc.lower()
+    return domain[4:] if domain.startswith("www.") else domain
+
+def extract_snippet(content: str, query: str, max_chars: int = SEARCH_SNIPPET_CHARS) -> str:
+    """The sentences of content that share the most words with the query, in page order, up to max_chars.
+
+    Falls back to the start of the page when no sentence mentions the query.
+    """
+    content = " ".join(str(content).split())
+    if len(content) <= max_chars:
+        return content
+    terms = query_terms(query)
+    sentences = SENTENCE_PATTERN.split(content)
+    overlaps = [len(terms & query_terms(sentence)) for sentence in sentences]
+    ranked = sorted(range(len(sentences)), key=lambda index: (-overlaps[index], index))
+    chosen = []
+    used = 0
+    for index in ranked:
+        if overlaps[index] == 0:
+            break
+        if used + len(sentences[index]) > max_chars:
+            continue
+        chosen.append(index)
+        used += len(sentences[index]) + 1
+    if not chosen:
+        return content[:max_chars].rsplit(" ", 1)[0] + "…"
+    return " ".join(sentences[index] for index in sorted(chosen))
+
+def compact_search_result(result: Dict[str, Any], query: str, token_budget: int, seen: set) -> Dict[str, Any]:
+    """Trim a Tavily response to what the model needs.
+
+    Results under SEARCH_MIN_SCORE (except the best one), URLs or domains already in
+    `seen` and anything past the token budget are dropped; page content is cut down to
+    a query-relevant snippet. Only this form is stored in the thread.
+    """
+    compacted = {"query": result.get("query", query)}
+    if result.get("answer"):
+        compacted["answer"] = result["answer"]
+    if "error" in result:
+        compacted["error"] = str(result["error"])
+    
+    items = sorted(result.get("results", []), key=lambda item: item.get("score") or 0, reverse=True)
+    kept = []
+    used = len(compacted.get("answer", "")) // 4
+    for rank, item in enumerate(items):
+        if rank > 0 and (item.get("score") or 0) < SEARCH_MIN_SCORE:
+            break
+        url = item.get("url", "")
+        key = url_domain(url) if SEARCH_DEDUP_DOMAINS else normalize_url(url)
+        if key in seen:
+            continue
+        entry = {
+            "url": url,
+            "title": item.get("title", ""),
+            "content": extract_snippet(item.get("content", ""), query),
+            "score": item.get("score", 0),
+        }
+        # Same 4 characters per token as count_tokens_approximately
+        tokens = (len(entry["title"]) + len(entry["content"]) + len(url)) // 4
+        if kept and used + tokens > token_budget:
+            break
+        seen.add(key)
+        kept.append(entry)
+        used += tokens
+    compacted["results"] = kept
+    return compacted
+
+async def run_search(args: Dict[str, Any], config, prefetched=None) -> Dict[str, Any]:
+    try:
+        search = prefetched if prefetched is not None else get_search_tool().ainvoke(args, config)
+        return await asyncio.wait_for(search, SEARCH_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        return {"error": f"Search timed out after {SEARCH_TIMEOUT_SECONDS:g}s"}
+    except QueueFullError:
+        raise
+    except Exception as error:
+        return {"error": repr(error)}
+
+async def run_tool(call, config) -> ToolMessage:
+    tool = next((tool for tool in get_tools() if tool.name == call["name"]), None)
+    if tool is None:
+        return ToolMessage(content=f"Error: {call['name']} is not a valid tool", name=call["name"], tool_call_id=call["id"], status="error")
+    try:
+        return await tool.ainvoke(call, config)
+    except QueueFullError:
+        raise
+    except Exception as error:
+        return ToolMessage(content=f"Error: {error!r}", name=call["name"], tool_call_id=call["id"], status="error")
+
+async def tool_node(state: State, config):
+    """Run every tool call of the last model message concurrently.
+
+    Searches are fanned out once per distinct normalized query, each under
+    SEARCH_TIMEOUT_SECONDS, and compacted as they finish: a URL (or domain) already
+    returned by an earlier-finishing query is dropped from later ones and each query
+    gets an even share of SEARCH_TOOL_TOKEN_BUDGET. Each query's results are streamed
+    as a `search_results` custom event as soon as it completes. A matching search
+    prefetched by the model node is reused instead of searching again.
+    """
+    calls = state["messages"][-1].tool_calls
+    thread_id = config.get("configurable", {}).get("thread_id")
+    seen = set()
+    searches = {}
+    
+    async def search(query: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        result = await run_search(args, config, prefetched=claim_search_prefetch(thread_id, args))
+        result = compact_search_result(result, query, SEARCH_TOOL_TOKEN_BUDGET // len(searches), seen)
+        results = result["results"]
+        event = {"query": query, "results": results}
+        if "error" in result:
+            event["error"] = str(result["error"])
+        await adispatch_custom_event("search_results", event, config=config)
+        return result
+    
+    tasks = []
+    keys = []
+    first_call_ids = {}
+    for call in calls:
+        if call["name"] != SEARCH_TOOL_NAME:
+            tasks.append(run_tool(call, config))
+            keys.append(None)
+            continue
+        args = call["args"]
+        query = args.get("query", "")
+        key = cache_key(normalize_text(query), {name: value for name, value in args.items() if name != "query"})
+        if key not in searches:
+            searches[key] = asyncio.ensure_future(search(query, args))
+            first_call_ids[key] = call["id"]
+        tasks.append(searches[key])
+        keys.append(key)
+    
+    try:
+        outputs = await asyncio.gather(*tasks)
+    finally:
+        for task in searches.values():
+            task.cancel()
+        discard_search_prefetch(thread_id)
+    
+    messages = []
+    answered = set()
+    for call, key, output in zip(calls, keys, outputs):
+        if key is None:
+            messages.append(output)
+            continue
+        if key in answered:
+            content = f"Duplicate of search call {first_call_ids[key]}; see its results."
+        else:
+            answered.add(key)
+            content = encode_json(output)
+        messages.append(ToolMessage(
+            content=content,
+            name=call["name"],
+            tool_call_id=call["id"],
+            status="error" if "error" in output else "success",
+        ))
+    return {"messages": messages}
 
 graph_builder = StateGraph(State)
-graph_builder.add_node("model", model)
-graph_builder.add_node("tool_node", tool_node)
+graph_builder.add_node("model", timed_node("model", model))
+graph_builder.add_node("tool_node", timed_node("tool_node", tool_node))
 graph_builder.set_entry_point("model")
 
 graph_builder.add_conditional_edges("model", tools_router, {
@@ -435,9 +2131,41 @@ graph_builder.add_conditional_edges("model", tools_router, {
 })
 graph_builder.add_edge("tool_node", "model")
 
-graph = graph_builder.compile(checkpointer=memory)
+@built_once
+def compile_graph(checkpointer: BaseCheckpointSaver):
+    return graph_builder.compile(checkpointer=checkpointer)
 
-app = FastAPI()
+def get_graph():
+    """The graph compiled against the checkpointer opened in lifespan"""
+    return compile_graph(memory)
+
+async def aget_graph():
+    return await compile_graph.abuild(memory)
+
+# Seconds spent per startup phase, reported by /ready and /metrics
+startup_timings: Dict[str, float] = {}
+warmup_task: Optional[asyncio.Future] = None
+
+def warm_up():
+    """Build providers, tools and the graph ahead of the first request that needs them"""
+    for name, build in (("search_tool", get_search_tool), ("model_routes", get_model_routes), ("graph", get_graph)):
+        started = time.perf_counter()
+        build()
+        startup_timings[f"warmup_{name}"] = time.perf_counter() - started
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global memory, warmup_task
+    started = time.perf_counter()
+    async with create_checkpointer() as checkpointer:
+        memory = checkpointer
+        startup_timings["checkpointer"] = time.perf_counter() - started
+        # Accept requests right away; anything they need before warm-up finishes is built on demand
+        warmup_task = asyncio.ensure_future(asyncio.to_thread(warm_up))
+        yield
+        await asyncio.gather(warmup_task, return_exceptions=True)
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -454,158 +2182,820 @@ def serialise_ai_message_chunk(chunk):
     else:
         raise TypeError(f"Object of type {type(chunk).__name__} is not correctly formatted for serialisation")
 
-async def generate_enhanced_chat_responses(message: str, checkpoint_id: Optional[str] = None):
-    """Enhanced streaming with consistent block structure"""
-    parser = EnhancedStreamingContentParser()
+def json_default(obj: Any) -> Any:
+    """Parser event records encode as their dict form; anything else unknown as its str()"""
+    if isinstance(obj, ParserEvent):
+        return obj.to_dict()
+    return str(obj)
+
+if orjson is not None:
+    def encode_json(obj: Any) -> str:
+        return orjson.dumps(obj, default=json_default).decode()
+else:
+    _json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+    def encode_json(obj: Any) -> str:
+        return _json_encoder.encode(obj)
+
+def sse_event(event: Any) -> str:
+    """Encode one stream event as an SSE frame"""
+    return f"data: {encode_json(event)}\n\n"
+
+# Per-token frames only vary in their content, so the fixed keys are encoded once
+CONTENT_FRAME_PREFIX = 'data: {"type":"content","content":'
+END_FRAME = sse_event({"type": "end"})
+
+def sse_content(content: str) -> str:
+    return f"{CONTENT_FRAME_PREFIX}{encode_json(content)}}}\n\n"
+
+# Bit positions of the booleans packed into `flags` by format=compact
+COMPACT_FLAGS = (
+    'has_formatting', 'has_links', 'has_inline_code', 'has_images', 'has_bold', 'has_italic',
+    'has_strikethrough', 'has_lists', 'has_tables', 'has_quotes', 'in_code_block', 'in_table',
+)
+COMPACT_SCHEMA_EVENT = {'type': 'schema', 'format': 'compact', 'flags': list(COMPACT_FLAGS)}
+
+def compact_event(event: Any) -> Any:
+    """Compact form of a parser event: booleans packed into `flags`, defaults and duplicate text dropped"""
+    if isinstance(event, dict):
+        # Stored blocks come back from the checkpointer as dicts
+        if event['type'] == 'content':
+            event = ContentEvent.from_dict(event)
+        elif event['type'] == 'block_start':
+            event = BlockStartEvent(event['block_info'])
+        else:
+            return event
+    
+    if isinstance(event, ContentEvent):
+        metadata = event.metadata
+        flags = 0
+        for bit, name in enumerate(COMPACT_FLAGS):
+            if getattr(metadata, name, False) or getattr(event, name, False):
+                flags |= 1 << bit
+        
+        compact = {'type': 'content', 'content': event.content}
+        if event.content_type != ContentType.PLAIN_TEXT.value:
+            compact['content_type'] = event.content_type
+        if flags:
+            compact['flags'] = flags
+        if metadata.word_count:
+            compact['word_count'] = metadata.word_count
+        language = metadata.language or event.code_language
+        if language:
+            compact['language'] = language
+        if event.block_type != BlockType.PARAGRAPH.value:
+            compact['block_type'] = event.block_type
+        if event.streamed:
+            compact['streamed'] = True
+        return compact
     
-    # Handle conversation setup
-    is_new_conversation = checkpoint_id is None
+    if isinstance(event, BlockStartEvent):
+        block_info = dict(event.block_info)
+        content = block_info.get('content')
+        metadata = {}
+        for key, value in block_info.get('metadata', {}).items():
+            # Skip false/empty values and anything that repeats the block's content or top-level fields
+            if value is False or value is None or value == content or value == block_info.get(key):
+                continue
+            if key == 'column_count' and content is not None and value == len(content):
+                continue
+            if key == 'headers' and content is not None:
+                # Rows repeat the header cells already sent with the header row; a
+                # table_group has no header row, so its headers stay
+                continue
+            metadata[key] = value
+        if metadata:
+            block_info['metadata'] = metadata
+        else:
+            block_info.pop('metadata', None)
+        return {'type': 'block_start', 'block_info': block_info}
     
-    if is_new_conversation:
-        new_checkpoint_id = str(uuid4())
-        config = {"configurable": {"thread_id": new_checkpoint_id}}
-        events = graph.astream_events(
-            {"messages": [SYSTEM_MESSAGE, HumanMessage(content=message)]},
-            version="v2",
-            config=config
-        )
-        yield f"data: {json.dumps({'type': 'checkpoint', 'checkpoint_id': new_checkpoint_id})}\n\n"
-    else:
-        config = {"configurable": {"thread_id": checkpoint_id}}
-        events = graph.astream_events(
-            {"messages": [SYSTEM_MESSAGE, HumanMessage(content=message)]},
-            version="v2",
-            config=config
-        )
+    return event
+
+def compact_sse_event(event: Any) -> str:
+    return sse_event(compact_event(event))
+
+def search_queries(tool_calls) -> List[str]:
+    """Distinct search queries requested in one model step, in call order"""
+    queries = {}
+    for call in tool_calls:
+        if call["name"] == SEARCH_TOOL_NAME:
+            query = call["args"].get("query", "")
+            queries.setdefault(normalize_text(query), query)
+    return list(queries.values())
+
+async def start_turn(message: str, checkpoint_id: Optional[str], **configurable):
+    """Start one turn's graph run, on a new thread when checkpoint_id is None.
 
-    # Process streaming events
+    Returns the run's config and its astream_events iterator; shared by every transport.
+    """
+    config = {"configurable": {"thread_id": checkpoint_id or str(uuid4()), **configurable}}
+    graph = await aget_graph()
+    events = graph.astream_events(
+        {"messages": [HumanMessage(content=message)]},
+        version="v2",
+        config=config
+    )
+    return config, events
+
+def search_results_event(data: Dict[str, Any]) -> Dict[str, Any]:
+    search_results = [
+        {
+            "url": item.get("url", ""),
+            "title": item.get("title", ""),
+            "snippet": item.get("content", ""),
+            "score": item.get("score", 0)
+        }
+        for item in data["results"]
+    ]
+    event = {
+        "type": "search_results",
+        "query": data["query"],
+        "results": search_results,
+        "result_count": len(search_results),
+        "urls": [r["url"] for r in search_results]
+    }
+    if "error" in data:
+        event["error"] = data["error"]
+    return event
+
+async def turn_events(events):
+    """Translate a turn's graph events into what every route streams alike.
+
+    Yields ("token", text) and ("model_end", None) for the route's own content handling,
+    and ("frame", sse) for search and queue events, ready to send.
+    """
     async for event in events:
+        if SUMMARY_TAG in event.get("tags", ()):
+            continue
         event_type = event["event"]
         
         if event_type == "on_chat_model_stream":
-            chunk_content = serialise_ai_message_chunk(event["data"]["chunk"])
+            yield "token", serialise_ai_message_chunk(event["data"]["chunk"])
+        
+        elif event_type == "on_chat_model_end":
+            yield "model_end", None
+            tool_calls = event["data"]["output"].tool_calls if hasattr(event["data"]["output"], "tool_calls") else []
+            for search_query in search_queries(tool_calls):
+                yield "frame", sse_event({"type": "search_start", "query": search_query, "timestamp": str(uuid4())})
+        
+        elif event_type == "on_custom_event" and event["name"] == "search_results":
+            yield "frame", sse_event(search_results_event(event["data"]))
+        
+        elif event_type == "on_custom_event" and event["name"] == "queue_position":
+            yield "frame", sse_event({"type": "queue_position", **event["data"]})
+
+async def generate_enhanced_chat_responses(
+    message: str,
+    checkpoint_id: Optional[str] = None,
+    compact: bool = False,
+    incremental: bool = False,
+    grouped: bool = False,
+    timing: bool = False,
+):
+    """Enhanced streaming with consistent block structure.
+
+    Records the request's latency breakdown in the /metrics histograms and, with
+    timing=True, ends the stream with it as a `timing` event.
+    """
+    request_timing = RequestTiming("enhanced")
+    try:
+        frames = enhanced_chat_frames(message, checkpoint_id, compact, incremental, grouped, request_timing)
+        async for frame in hold_thread(frames, checkpoint_id):
+            request_timing.frame(frame)
+            yield frame
+        if timing:
+            yield sse_event({"type": "timing", **request_timing.summary()})
+    finally:
+        request_timing.observe()
+
+async def enhanced_chat_frames(
+    message: str,
+    checkpoint_id: Optional[str],
+    compact: bool,
+    incremental: bool,
+    grouped: bool,
+    request_timing: RequestTiming,
+):
+    parser = EnhancedStreamingContentParser(incremental=incremental, grouped=grouped)
+    encode_event = compact_sse_event if compact else sse_event
+    if compact:
+        yield sse_event(COMPACT_SCHEMA_EVENT)
+    
+    config, events = await start_turn(message, checkpoint_id, request_timing=request_timing)
+    if checkpoint_id is None:
+        yield sse_event({'type': 'checkpoint', 'checkpoint_id': config["configurable"]["thread_id"]})
+
+    # The parser's final events, stored with the thread once the run completes. Incremental
+    # content_delta events are left out: each line's content event repeats their text in full.
+    parsed_log: List[Any] = []
+    
+    async for kind, value in turn_events(events):
+        if kind == "frame":
+            yield value
+        
+        elif kind == "token":
+            if value:
+                request_timing.token()
             
             # Process content through parser
-            parsed_events = parser.process_content_chunk(chunk_content)
+            parsing = time.perf_counter()
+            parsed_events = parser.process_content_chunk(value)
+            request_timing.parser += time.perf_counter() - parsing
+            parsed_log.extend(event for event in parsed_events if not isinstance(event, ContentDeltaEvent))
             
             for parsed_event in parsed_events:
-                yield f"data: {json.dumps(parsed_event)}\n\n"
+                yield encode_event(parsed_event)
                 
-        elif event_type == "on_chat_model_end":
+        elif kind == "model_end":
+            request_timing.generation_end()
             # Process any remaining content
+            parsing = time.perf_counter()
             final_events = parser.finalize()
+            request_timing.parser += time.perf_counter() - parsing
+            parsed_log.extend(final_events)
             for final_event in final_events:
-                yield f"data: {json.dumps(final_event)}\n\n"
-            
-            # Handle tool calls
-            tool_calls = event["data"]["output"].tool_calls if hasattr(event["data"]["output"], "tool_calls") else []
-            search_calls = [call for call in tool_calls if call["name"] == "tavily_search_results_json"]
-            
-            if search_calls:
-                search_query = search_calls[0]["args"].get("query", "")
-                search_data = {
-                    "type": "search_start",
-                    "query": search_query,
-                    "timestamp": str(uuid4())
-                }
-                yield f"data: {json.dumps(search_data)}\n\n"
-                
-        elif event_type == "on_tool_end" and event["name"] == "tavily_search_results_json":
-            output = event["data"]["output"]
-            
-            if isinstance(output, list):
-                search_results = []
-                for item in output:
-                    if isinstance(item, dict):
-                        search_results.append({
-                            "url": item.get("url", ""),
-                            "title": item.get("title", ""),
-                            "snippet": item.get("snippet", ""),
-                            "score": item.get("score", 0)
-                        })
-                
-                search_results_data = {
-                    "type": "search_results",
-                    "results": search_results,
-                    "result_count": len(search_results),
-                    "urls": [r["url"] for r in search_results]
-                }
-                yield f"data: {json.dumps(search_results_data)}\n\n"
+                yield encode_event(final_event)
+    
+    await (await aget_graph()).aupdate_state(config, {"blocks": [event_dict(event) for event in parsed_log]}, as_node="model")
 
 async def generate_chat_responses(message: str, checkpoint_id: Optional[str] = None):
-    is_new_conversation = checkpoint_id is None
+    config, events = await start_turn(message, checkpoint_id)
+    if checkpoint_id is None:
+        yield sse_event({"type": "checkpoint", "checkpoint_id": config["configurable"]["thread_id"]})
+
+    async for kind, value in turn_events(events):
+        if kind == "token":
+            yield sse_content(value)
+        elif kind == "frame":
+            yield value
     
-    if is_new_conversation:
-        new_checkpoint_id = str(uuid4())
+    yield END_FRAME
 
-        config = {
-            "configurable": {
-                "thread_id": new_checkpoint_id
-            }
-        }
+def coalesced_frame(payloads: List[str], event_id: Optional[str]) -> str:
+    frame = f"data: [{','.join(payloads)}]\n\n"
+    return f"id: {event_id}\n{frame}" if event_id is not None else frame
+
+async def coalesce_frames(frames, flush_ms: int, flush_bytes: int):
+    """Merge SSE frames into one `data: [...]` frame per flush window.
+
+    A window is flushed flush_ms after its first event arrives or once its payload
+    reaches flush_bytes, whichever comes first.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = frames.__aiter__()
+    pending = asyncio.ensure_future(iterator.__anext__())
+    buffer: List[str] = []
+    buffered_bytes = 0
+    deadline = 0.0
+    # A merged frame takes the id of the last event in it
+    last_id = None
+    try:
+        while True:
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if pending in done:
+                try:
+                    frame = pending.result()
+                except StopAsyncIteration:
+                    break
+                pending = asyncio.ensure_future(iterator.__anext__())
+                
+                # Frames are `[id: <id>\n]data: <json>\n\n`; keep the JSON as-is
+                if frame.startswith("id: "):
+                    id_line, frame = frame.split("\n", 1)
+                    last_id = id_line[4:]
+                payload = frame[6:-2]
+                if not buffer:
+                    deadline = loop.time() + flush_ms / 1000
+                buffer.append(payload)
+                buffered_bytes += len(payload)
+                if buffered_bytes < flush_bytes and loop.time() < deadline:
+                    continue
+            
+            yield coalesced_frame(buffer, last_id)
+            buffer = []
+            buffered_bytes = 0
         
-        events = graph.astream_events(
-            {"messages": [SYSTEM_MESSAGE,HumanMessage(content=message)]},
-            version="v2",
-            config=config
-        )
+        if buffer:
+            yield coalesced_frame(buffer, last_id)
+    finally:
+        if not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+        await iterator.aclose()
+
+async def overload_guard(frames):
+    """End the stream with an error event when a provider queue or busy thread rejects the run"""
+    try:
+        async for frame in frames:
+            yield frame
+    except QueueFullError as error:
+        yield sse_event({"type": "error", "status": 429, "message": str(error)})
+        yield END_FRAME
+    except ThreadBusyError as error:
+        yield sse_event({"type": "error", "status": 409, "message": str(error)})
+        yield END_FRAME
+    finally:
+        await frames.aclose()
+
+async def hold_thread(frames, checkpoint_id: Optional[str]):
+    """Run a follow-up turn while holding its thread's lock, so two requests on one
+    thread run one after the other instead of interleaving their checkpoint writes"""
+    if checkpoint_id is None:
+        async for frame in frames:
+            yield frame
+        return
+    async with thread_locks.hold(checkpoint_id):
+        async for frame in frames:
+            yield frame
+
+def reject_if_overloaded():
+    if model_limiter.is_full:
+        raise HTTPException(status_code=429, detail="Server is busy, try again shortly", headers={"Retry-After": "1"})
+
+class StreamRun:
+    """A generation that runs detached from the connection that started it.
+
+    Frames are numbered and kept in a ring buffer of the last STREAM_BUFFER_EVENTS, so a
+    client that reconnects with Last-Event-ID gets only what it missed while the
+    generation carries on regardless of the socket.
+    """
+
+    def __init__(self, run_id: str, frames, max_events: int = STREAM_BUFFER_EVENTS):
+        self.run_id = run_id
+        self.events: deque = deque(maxlen=max_events)
+        self.next_seq = 1
+        self.finished_at: Optional[float] = None
+        self.followers = 0
+        self._abandoned: Optional[asyncio.TimerHandle] = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run(frames))
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def _append(self, frame: str):
+        self.events.append((self.next_seq, frame))
+        self.next_seq += 1
+        self._notify()
+
+    async def _run(self, frames):
+        try:
+            async for frame in frames:
+                self._append(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception as error:
+            # Buffered like any other frame, so live followers and later resumes all end cleanly
+            self._append(sse_event({"type": "error", "status": 500, "message": str(error)}))
+            self._append(END_FRAME)
+        finally:
+            # Closing the generator here unwinds the graph run and releases the thread lock
+            await frames.aclose()
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def _attach(self):
+        self.followers += 1
+        if self._abandoned is not None:
+            self._abandoned.cancel()
+            self._abandoned = None
+
+    def _detach(self):
+        self.followers -= 1
+        if self.followers == 0 and not self.done:
+            self._abandoned = asyncio.get_running_loop().call_later(STREAM_DISCONNECT_GRACE_SECONDS, self.cancel)
+
+    def cancel(self):
+        """Stop the generation; the task's cancellation reaches the in-flight model and tool calls"""
+        if not self.done:
+            CANCELLED_RUNS.inc()
+            self.task.cancel()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self, after: int = 0):
+        """Yield `id:`-tagged frames numbered after `after`, then live ones until the run ends"""
+        resumed = after > 0
+        sent = False
+        frames = self._follow(after)
+        self._attach()
+        try:
+            async for frame in frames:
+                sent = True
+                yield frame
+        finally:
+            # A disconnected client lands here too
+            self._detach()
+            await frames.aclose()
         
-        yield f"data: {{\"type\": \"checkpoint\", \"checkpoint_id\": \"{new_checkpoint_id}\"}}\n\n"
+        if resumed and not sent and self.done:
+            # Reconnected after the run finished with nothing left to send; tell the client to stop
+            yield END_FRAME
+
+    async def _follow(self, after: int):
+        while True:
+            changed = self._changed
+            if self.events and self.events[0][0] > after + 1:
+                yield sse_event({"type": "error", "status": 410, "message": "Missed events are no longer buffered"})
+                yield END_FRAME
+                return
+            for seq, frame in list(self.events):
+                if seq > after:
+                    after = seq
+                    yield f"id: {self.run_id}-{seq}\n{frame}"
+            if self.done:
+                break
+            await changed.wait()
+
+# Generations by run id, live ones first to last started, finished ones kept for resumes
+stream_runs: "OrderedDict[str, StreamRun]" = OrderedDict()
+
+def prune_stream_runs():
+    now = time.monotonic()
+    finished = [run for run in stream_runs.values() if run.done]
+    excess = len(finished) - STREAM_MAX_FINISHED_RUNS
+    for index, run in enumerate(sorted(finished, key=lambda run: run.finished_at)):
+        if index < excess or now - run.finished_at > STREAM_RUN_TTL_SECONDS:
+            del stream_runs[run.run_id]
+
+def start_stream_run(frames) -> StreamRun:
+    prune_stream_runs()
+    run = StreamRun(uuid4().hex, overload_guard(frames))
+    stream_runs[run.run_id] = run
+    return run
+
+def find_stream_run(last_event_id: str) -> tuple:
+    """Parse a Last-Event-ID of the form <run id>-<seq> into (run or None, seq)"""
+    run_id, _, seq = last_event_id.strip().rpartition("-")
+    if not seq.isdigit():
+        return None, 0
+    return stream_runs.get(run_id), int(seq)
+
+async def resume_unavailable():
+    yield sse_event({"type": "error", "status": 410, "message": "This stream can no longer be resumed"})
+    yield END_FRAME
+
+def run_stream_response(
+    frames,
+    coalesce_ms: Optional[int] = None,
+    coalesce_bytes: int = 16384,
+    last_event_id: Optional[str] = None,
+) -> StreamingResponse:
+    """SSE response for a generation: a new detached run, or a resume of one by Last-Event-ID"""
+    if last_event_id:
+        run, after = find_stream_run(last_event_id)
+        frames = run.follow(after) if run is not None else resume_unavailable()
     else:
-        config = {
-            "configurable": {
-                "thread_id": checkpoint_id
-            }
-        }
-        events = graph.astream_events(
-            {"messages": [SYSTEM_MESSAGE,HumanMessage(content=message)]},
-            version="v2",
-            config=config
-        )
+        frames = start_stream_run(frames).follow()
+    if coalesce_ms is not None:
+        frames = coalesce_frames(frames, coalesce_ms, coalesce_bytes)
+    return StreamingResponse(frames, media_type="text/event-stream")
 
-    async for event in events:
-        event_type = event["event"]
-        
-        if event_type == "on_chat_model_stream":
-            chunk_content = serialise_ai_message_chunk(event["data"]["chunk"])
-            safe_content = chunk_content.replace("'", "\\'").replace("\n", "\\n")
+def event_stream_response(frames, coalesce_ms: Optional[int] = None, coalesce_bytes: int = 16384) -> StreamingResponse:
+    """SSE response, optionally batching frames when the client asked for coalesce_ms"""
+    frames = overload_guard(frames)
+    if coalesce_ms is not None:
+        frames = coalesce_frames(frames, coalesce_ms, coalesce_bytes)
+    return StreamingResponse(frames, media_type="text/event-stream")
+
+@app.get("/chat_stream/{message}")
+async def chat_stream(
+    message: str,
+    checkpoint_id: Optional[str] = Query(None),
+    coalesce_ms: Optional[int] = Query(None, ge=0),
+    coalesce_bytes: int = Query(16384, ge=1),
+    last_event_id: Optional[str] = Header(None),
+):
+    if last_event_id:
+        return run_stream_response(None, coalesce_ms, coalesce_bytes, last_event_id)
+    reject_if_overloaded()
+    return run_stream_response(hold_thread(generate_chat_responses(message, checkpoint_id), checkpoint_id), coalesce_ms, coalesce_bytes)
+
+@app.get("/enhanced_chat_stream/{message}")
+async def enhanced_chat_stream(
+    message: str,
+    checkpoint_id: Optional[str] = Query(None),
+    coalesce_ms: Optional[int] = Query(None, ge=0),
+    coalesce_bytes: int = Query(16384, ge=1),
+    event_format: Literal["full", "compact"] = Query("full", alias="format"),
+    incremental: bool = Query(False),
+    grouped: bool = Query(False),
+    timing: bool = Query(False),
+    last_event_id: Optional[str] = Header(None),
+):
+    if last_event_id:
+        return run_stream_response(None, coalesce_ms, coalesce_bytes, last_event_id)
+    reject_if_overloaded()
+    return run_stream_response(
+        generate_enhanced_chat_responses(
+            message,
+            checkpoint_id,
+            compact=event_format == "compact",
+            incremental=incremental,
+            grouped=grouped,
+            timing=timing,
+        ),
+        coalesce_ms,
+        coalesce_bytes,
+    )
+
+class BatchJob(BaseModel):
+    message: str
+    checkpoint_id: Optional[str] = None
+    # Tags every event of the job; defaults to the job's index in the batch
+    id: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    jobs: List[BatchJob] = Field(min_length=1, max_length=BATCH_MAX_JOBS)
+
+def tag_frame(frame: str, job_id_json: str) -> str:
+    """Add job_id to an SSE frame's JSON object without decoding it"""
+    return f'data: {{"job_id":{job_id_json},{frame[7:]}'
+
+async def run_batch(jobs: Dict[str, BatchJob], **options):
+    """Run a batch's jobs BATCH_CONCURRENCY at a time.
+
+    Yields (job_id, frame) as each job's frames arrive, in order within a job, and
+    (job_id, None) once a job has ended. Jobs still queue for model and search slots
+    like any other request, and identical searches across jobs share one call.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+    budget = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run_job(job_id: str, job: BatchJob):
+        async with budget:
+            frames = overload_guard(generate_enhanced_chat_responses(job.message, job.checkpoint_id, **options))
+            try:
+                async for frame in frames:
+                    await queue.put((job_id, frame))
+            except Exception as error:
+                # One failed job ends with an error event instead of taking the batch down
+                await queue.put((job_id, sse_event({"type": "error", "status": 500, "message": str(error)})))
+        await queue.put((job_id, None))
+    
+    tasks = [asyncio.ensure_future(run_job(job_id, job)) for job_id, job in jobs.items()]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            job_id, frame = await queue.get()
+            if frame is None:
+                remaining -= 1
+            yield job_id, frame
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def batch_frames(jobs: Dict[str, BatchJob], **options):
+    """One SSE stream for a whole batch: every event tagged with its job_id, a job_end per job"""
+    job_id_json = {job_id: encode_json(job_id) for job_id in jobs}
+    async for job_id, frame in run_batch(jobs, **options):
+        if frame is None:
+            yield sse_event({"type": "job_end", "job_id": job_id})
+        else:
+            yield tag_frame(frame, job_id_json[job_id])
+    yield sse_event({"type": "batch_end", "jobs": len(jobs)})
+    yield END_FRAME
+
+CHECKPOINT_FRAME_PREFIX = 'data: {"type":"checkpoint"'
+ERROR_FRAME_PREFIX = 'data: {"type":"error"'
+
+async def batch_results(jobs: Dict[str, BatchJob], **options):
+    """One NDJSON line per job, written as soon as the job completes"""
+    payloads: Dict[str, List[str]] = {job_id: [] for job_id in jobs}
+    checkpoint_ids = {job_id: job.checkpoint_id for job_id, job in jobs.items()}
+    failed = set()
+    async for job_id, frame in run_batch(jobs, **options):
+        if frame is not None:
+            if frame.startswith(CHECKPOINT_FRAME_PREFIX):
+                checkpoint_ids[job_id] = json.loads(frame[6:])["checkpoint_id"]
+            elif frame.startswith(ERROR_FRAME_PREFIX):
+                failed.add(job_id)
+            payloads[job_id].append(frame[6:-2])
+            continue
+        # Events are already encoded; splice them in rather than decoding and re-encoding
+        events = ",".join(payloads.pop(job_id))
+        header = encode_json({"job_id": job_id, "checkpoint_id": checkpoint_ids[job_id], "ok": job_id not in failed})
+        yield f'{header[:-1]},"events":[{events}]}}\n'
+
+@app.post("/batch")
+async def batch(
+    request: BatchRequest,
+    stream: bool = Query(True),
+    coalesce_ms: Optional[int] = Query(None, ge=0),
+    coalesce_bytes: int = Query(16384, ge=1),
+    event_format: Literal["full", "compact"] = Query("full", alias="format"),
+    incremental: bool = Query(False),
+    grouped: bool = Query(False),
+    last_event_id: Optional[str] = Header(None),
+):
+    """Generate many prompts over one connection.
+
+    Streams the jobs' events multiplexed as SSE, each tagged with its job_id, or with
+    stream=false returns NDJSON with one line per job as each one completes.
+    """
+    if last_event_id and stream:
+        return run_stream_response(None, coalesce_ms, coalesce_bytes, last_event_id)
+    jobs = {job.id if job.id is not None else str(index): job for index, job in enumerate(request.jobs)}
+    if len(jobs) != len(request.jobs):
+        raise HTTPException(status_code=422, detail="Job ids must be unique within a batch")
+    reject_if_overloaded()
+    
+    options = dict(compact=event_format == "compact", incremental=incremental, grouped=grouped)
+    if not stream:
+        return StreamingResponse(batch_results(jobs, **options), media_type="application/x-ndjson")
+    return run_stream_response(batch_frames(jobs, **options), coalesce_ms, coalesce_bytes)
+
+def ws_message(frame: str, stream_id_json: str) -> str:
+    """WebSocket form of an SSE frame: its event, or coalesced `events`, tagged with
+    stream_id and the event_id to resume from"""
+    head = f'{{"stream_id":{stream_id_json}'
+    if frame.startswith("id: "):
+        id_line, frame = frame.split("\n", 1)
+        head += f',"event_id":{encode_json(id_line[4:])}'
+    payload = frame[6:-2]
+    if payload.startswith("["):
+        return f'{head},"events":{payload}}}'
+    return f'{head},{payload[1:]}'
+
+@app.websocket("/ws")
+async def websocket_streams(websocket: WebSocket):
+    """Many concurrent generations over one long-lived connection.
+
+    Client messages, JSON:
+      {"type": "prompt", "stream_id", "message", "checkpoint_id"?, "format"?, "incremental"?,
+       "grouped"?, "timing"?, "coalesce_ms"?, "coalesce_bytes"?}
+      {"type": "cancel", "stream_id"}
+      {"type": "resume", "stream_id", "last_event_id"}
+    Server messages carry the /enhanced_chat_stream events tagged with stream_id. Prompts start
+    the same detached runs as the SSE routes, so a stream can be resumed over either transport.
+    """
+    await websocket.accept()
+    # One writer drains the outbox, so concurrent streams never interleave a send
+    outbox: asyncio.Queue = asyncio.Queue(maxsize=256)
+    # stream_id -> (run or None, task forwarding its frames)
+    streams: Dict[str, tuple] = {}
+    
+    async def send_error(status: int, message: str, stream_id: Optional[str] = None):
+        error = {"type": "error", "status": status, "message": message}
+        if stream_id is not None:
+            error["stream_id"] = stream_id
+        await outbox.put(encode_json(error))
+    
+    async def forward(stream_id: str, frames):
+        stream_id_json = encode_json(stream_id)
+        try:
+            async for frame in frames:
+                await outbox.put(ws_message(frame, stream_id_json))
+        except Exception as error:
+            # The client must still hear that this stream is over
+            await send_error(500, str(error), stream_id)
+        finally:
+            await frames.aclose()
+            if streams.get(stream_id, (None, None))[1] is asyncio.current_task():
+                del streams[stream_id]
+    
+    def open_stream(stream_id: str, run: Optional[StreamRun], frames, coalesce: Optional[tuple]):
+        if coalesce is not None:
+            frames = coalesce_frames(frames, *coalesce)
+        streams[stream_id] = (run, asyncio.ensure_future(forward(stream_id, frames)))
+    
+    async def writer():
+        while True:
+            await websocket.send_text(await outbox.get())
+    
+    writer_task = asyncio.ensure_future(writer())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                # Text frames, or the same JSON in a binary frame
+                request = json.loads(message.get("text") or message.get("bytes") or "")
+            except ValueError:
+                await send_error(400, "Messages must be JSON objects")
+                continue
+            if not isinstance(request, dict):
+                await send_error(400, "Messages must be JSON objects")
+                continue
             
-            yield f"data: {{\"type\": \"content\", \"content\": \"{safe_content}\"}}\n\n"
+            message_type = request.get("type")
+            stream_id = request.get("stream_id")
+            if not isinstance(stream_id, str):
+                await send_error(400, "stream_id is required")
+                continue
             
-        elif event_type == "on_chat_model_end":
-            tool_calls = event["data"]["output"].tool_calls if hasattr(event["data"]["output"], "tool_calls") else []
-            search_calls = [call for call in tool_calls if call["name"] == "tavily_search_results_json"]
+            if message_type == "cancel":
+                run, task = streams.pop(stream_id, (None, None))
+                if task is None:
+                    await send_error(404, "No active stream with this stream_id", stream_id)
+                    continue
+                task.cancel()
+                if run is not None:
+                    run.cancel()
+                await outbox.put(encode_json({"stream_id": stream_id, "type": "end", "cancelled": True}))
+                continue
             
-            if search_calls:
-                search_query = search_calls[0]["args"].get("query", "")
-                safe_query = search_query.replace('"', '\\"').replace("'", "\\'").replace("\n", "\\n")
-                yield f"data: {{\"type\": \"search_start\", \"query\": \"{safe_query}\"}}\n\n"
-                
-        elif event_type == "on_tool_end" and event["name"] == "tavily_search_results_json":
-            output = event["data"]["output"]
+            if message_type not in ("prompt", "resume"):
+                await send_error(400, f"Unknown message type: {message_type!r}", stream_id)
+                continue
+            if stream_id in streams:
+                await send_error(409, "stream_id is already in use on this connection", stream_id)
+                continue
+            try:
+                coalesce = None
+                if request.get("coalesce_ms") is not None:
+                    coalesce = (int(request["coalesce_ms"]), int(request.get("coalesce_bytes", 16384)))
+                    if coalesce[0] < 0 or coalesce[1] < 1:
+                        raise ValueError
+            except (TypeError, ValueError):
+                await send_error(400, "coalesce_ms must be >= 0 and coalesce_bytes >= 1", stream_id)
+                continue
             
-            # Check if output is a list 
-            if isinstance(output, list):
-                urls = []
-                for item in output:
-                    if isinstance(item, dict) and "url" in item:
-                        urls.append(item["url"])
-                
-                urls_json = json.dumps(urls)
-                yield f"data: {{\"type\": \"search_results\", \"urls\": {urls_json}}}\n\n"
-    
-    yield f"data: {{\"type\": \"end\"}}\n\n"
+            if message_type == "resume":
+                run, after = find_stream_run(str(request.get("last_event_id", "")))
+                open_stream(stream_id, run, run.follow(after) if run is not None else resume_unavailable(), coalesce)
+                continue
+            
+            if not isinstance(request.get("message"), str):
+                await send_error(400, "message is required", stream_id)
+                continue
+            if not isinstance(request.get("checkpoint_id"), (str, type(None))):
+                await send_error(400, "checkpoint_id must be a string", stream_id)
+                continue
+            if model_limiter.is_full:
+                await send_error(429, "Server is busy, try again shortly", stream_id)
+                continue
+            run = start_stream_run(generate_enhanced_chat_responses(
+                request["message"],
+                request.get("checkpoint_id"),
+                compact=request.get("format") == "compact",
+                incremental=bool(request.get("incremental")),
+                grouped=bool(request.get("grouped")),
+                timing=bool(request.get("timing")),
+            ))
+            open_stream(stream_id, run, run.follow(), coalesce)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # The runs themselves carry on for STREAM_DISCONNECT_GRACE_SECONDS, resumable from a new connection
+        tasks = [writer_task, *(task for _, task in streams.values())]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-@app.get("/chat_stream/{message}")
-async def chat_stream(message: str, checkpoint_id: Optional[str] = Query(None)):
-    return StreamingResponse(
-        generate_chat_responses(message, checkpoint_id), 
-        media_type="text/event-stream"
-    )
+async def generate_stored_blocks(events: List[Dict[str, Any]], compact: bool = False):
+    if compact:
+        yield sse_event(COMPACT_SCHEMA_EVENT)
+    encode_event = compact_sse_event if compact else sse_event
+    for event in events:
+        yield encode_event(event)
 
-@app.get("/enhanced_chat_stream/{message}")
-async def enhanced_chat_stream(message: str, checkpoint_id: Optional[str] = Query(None)):
-    return StreamingResponse(
-        generate_enhanced_chat_responses(message, checkpoint_id), 
-        media_type="text/event-stream"
-    )
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/model_routes")
+async def model_routes_stats():
+    return {name: route.stats() for name, route in (await get_model_routes.abuild()).items()}
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once providers, tools and the graph are warm, 503 before"""
+    if warmup_task is None or not warmup_task.done():
+        raise HTTPException(status_code=503, detail="Warming up")
+    if warmup_task.exception() is not None:
+        raise HTTPException(status_code=503, detail=f"Warm-up failed: {warmup_task.exception()!r}")
+    return {"ready": True, "startup_seconds": {phase: round(seconds, 4) for phase, seconds in startup_timings.items()}}
+
+@app.get("/thread/{checkpoint_id}/blocks")
+async def thread_blocks(
+    checkpoint_id: str,
+    stream: bool = Query(True),
+    coalesce_ms: Optional[int] = Query(None, ge=0),
+    coalesce_bytes: int = Query(16384, ge=1),
+    event_format: Literal["full", "compact"] = Query("full", alias="format"),
+):
+    """Replay the parsed events of a thread's latest generation without calling the model"""
+    snapshot = await (await aget_graph()).aget_state({"configurable": {"thread_id": checkpoint_id}})
+    events = snapshot.values.get("blocks")
+    if events is None:
+        raise HTTPException(status_code=404, detail="No stored blocks for this checkpoint")
+    
+    compact = event_format == "compact"
+    if not stream:
+        if compact:
+            return {"checkpoint_id": checkpoint_id, "schema": COMPACT_SCHEMA_EVENT, "events": [compact_event(event) for event in events]}
+        return {"checkpoint_id": checkpoint_id, "events": events}
+    return event_stream_response(generate_stored_blocks(events, compact), coalesce_ms, coalesce_bytes)
+
+startup_timings["import"] = time.perf_counter() - IMPORT_STARTED
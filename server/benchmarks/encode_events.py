@@ -0,0 +1,71 @@
+"""Micro-benchmark for stream event serialization.
+
+Compares the hand-built frames the legacy /chat_stream used to emit and the
+stdlib json.dumps frames of /enhanced_chat_stream against the shared encoder.
+
+Run from the server directory:
+    python -m benchmarks.encode_events
+"""
+import json
+import timeit
+
+from benchmarks.fakes import use_fake_backends
+
+use_fake_backends()
+
+import app
+
+SAMPLE_DOCUMENT = """# Project brief
+## Goals
+Ship the **new editor** by Q3 with `realtime` collaboration and [docs](https://example.com).
+- Faster load times
+- Offline support with "quoted" text and a \\ backslash
+1. Research
+2. Build
+> Keep it simple.
+| Phase | Owner |
+|---|---|
+| Design | Ana |
+```python
+def main():
+    print("hello")
+```
+---
+"""
+
+def parsed_events():
+    parser = app.EnhancedStreamingContentParser()
+    events = parser.process_content_chunk(SAMPLE_DOCUMENT * 20)
+    return events + parser.finalize()
+
+def token_chunks():
+    return [token + " " for token in SAMPLE_DOCUMENT.split(" ")] * 20
+
+def legacy_content_frame(chunk):
+    safe_content = chunk.replace("'", "\\'").replace("\n", "\\n")
+    return f"data: {{\"type\": \"content\", \"content\": \"{safe_content}\"}}\n\n"
+
+def stdlib_frame(event):
+    return f"data: {json.dumps(app.event_dict(event))}\n\n"
+
+def bench(label, func, items, number):
+    seconds = timeit.timeit(lambda: [func(item) for item in items], number=number)
+    per_item = seconds / (number * len(items)) * 1e6
+    print(f"  {label:<32} {per_item:8.3f} us/event")
+
+def main(number: int = 50):
+    events = parsed_events()
+    chunks = token_chunks()
+    encoder = "orjson" if app.orjson is not None else "stdlib json"
+    
+    print(f"Token frames ({len(chunks)} chunks, encoder: {encoder})")
+    bench("legacy string replace", legacy_content_frame, chunks, number)
+    bench("json.dumps", lambda chunk: stdlib_frame({"type": "content", "content": chunk}), chunks, number)
+    bench("sse_content", app.sse_content, chunks, number)
+    
+    print(f"Parsed block events ({len(events)} events)")
+    bench("json.dumps", stdlib_frame, events, number)
+    bench("sse_event", app.sse_event, events, number)
+
+if __name__ == "__main__":
+    main()
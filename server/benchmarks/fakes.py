@@ -0,0 +1,19 @@
+"""Point the app at the local fake model and search backends.
+
+Call use_fake_backends() before importing app; settings are read at import time.
+"""
+import os
+
+def use_fake_backends(tokens_per_second: float = 0, token_chars: int = 4, search_latency_ms: float = 0, **settings: str):
+    os.environ.update({
+        "FAST_MODEL": "fake:fast",
+        "STRONG_MODEL": "fake:strong",
+        "SEARCH_BACKEND": "fake",
+        "FAKE_LLM_TOKENS_PER_SECOND": str(tokens_per_second),
+        "FAKE_LLM_TOKEN_CHARS": str(token_chars),
+        "FAKE_SEARCH_LATENCY_MS": str(search_latency_ms),
+        # Benchmarks measure the pipeline, not cache hits
+        "RESPONSE_CACHE_MAX_ENTRIES": "0",
+        "SEARCH_CACHE_MAX_ENTRIES": "0",
+        **settings,
+    })
@@ -0,0 +1,112 @@
+"""End-to-end SSE load test: time to first byte and events/sec at N concurrent clients.
+
+Starts the app in-process on uvicorn with the fake backends, so results reflect this
+server rather than provider latency. Clients share the server's event loop; pass --url
+to load a separately started server instead.
+
+Run from the server directory:
+    python -m benchmarks.load_test [--clients 1 10 50] [--tokens-per-second 200]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import quote
+
+import httpx
+
+from benchmarks.fakes import use_fake_backends
+
+PROMPT = "Write a short project brief"
+
+async def stream_once(client: httpx.AsyncClient, path: str, params: dict) -> tuple:
+    started = time.perf_counter()
+    first_byte = None
+    first_content = None
+    events = 0
+    async with client.stream("GET", path, params=params) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            if first_content is None and '"type":"content' in line:
+                first_content = time.perf_counter() - started
+            if line.startswith("data: "):
+                # Coalesced frames carry a JSON array of events
+                events += len(json.loads(line[6:])) if line.startswith("data: [") else 1
+    return first_byte, first_content or first_byte, events, time.perf_counter() - started
+
+async def run_level(base_url: str, clients: int, requests_per_client: int, path: str, params: dict) -> dict:
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=httpx.Limits(max_connections=clients)) as client:
+        async def client_loop():
+            return [await stream_once(client, path, params) for _ in range(requests_per_client)]
+        
+        started = time.perf_counter()
+        results = [result for batch in await asyncio.gather(*(client_loop() for _ in range(clients))) for result in batch]
+        seconds = time.perf_counter() - started
+    
+    ttfb = sorted(result[0] for result in results)
+    first_content = sorted(result[1] for result in results)
+    events = sum(result[2] for result in results)
+    return {
+        "clients": clients,
+        "requests": len(results),
+        "ttfb_p50_ms": statistics.median(ttfb) * 1000,
+        "ttfb_p95_ms": ttfb[min(len(ttfb) - 1, int(len(ttfb) * 0.95))] * 1000,
+        "first_content_p50_ms": statistics.median(first_content) * 1000,
+        "stream_p50_ms": statistics.median(result[3] for result in results) * 1000,
+        "events_per_sec": events / seconds,
+    }
+
+async def serve_app():
+    import uvicorn
+    import app
+    
+    server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=0, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f"http://127.0.0.1:{port}"
+
+async def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arguments.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50])
+    arguments.add_argument("--requests-per-client", type=int, default=3)
+    arguments.add_argument("--tokens-per-second", type=float, default=200, help="fake model rate; 0 for no delay")
+    arguments.add_argument("--search-latency-ms", type=float, default=100)
+    arguments.add_argument("--prompt", default=PROMPT, help="prompts with 'latest', 'news', ... trigger a fake search")
+    arguments.add_argument("--endpoint", choices=["enhanced", "chat"], default="enhanced")
+    arguments.add_argument("--param", action="append", default=[], metavar="KEY=VALUE", help="extra query parameter, e.g. grouped=true")
+    arguments.add_argument("--url", help="target an already running server instead of starting one")
+    options = arguments.parse_args()
+    
+    server = None
+    base_url = options.url
+    if base_url is None:
+        use_fake_backends(
+            tokens_per_second=options.tokens_per_second,
+            search_latency_ms=options.search_latency_ms,
+            # Let the configured concurrency levels through instead of measuring 429s
+            MODEL_QUEUE_SIZE=str(max(options.clients) * 2),
+        )
+        server, task, base_url = await serve_app()
+    
+    path = f"/{'enhanced_chat_stream' if options.endpoint == 'enhanced' else 'chat_stream'}/{quote(options.prompt)}"
+    params = dict(param.split("=", 1) for param in options.param)
+    try:
+        print(f"{'clients':>7} {'requests':>8} {'ttfb p50':>10} {'ttfb p95':>10} {'content p50':>12} {'stream p50':>11} {'events/sec':>11}")
+        for clients in options.clients:
+            level = await run_level(base_url, clients, options.requests_per_client, path, params)
+            print(
+                f"{level['clients']:>7} {level['requests']:>8} {level['ttfb_p50_ms']:>8.1f}ms {level['ttfb_p95_ms']:>8.1f}ms {level['first_content_p50_ms']:>10.1f}ms "
+                f"{level['stream_p50_ms']:>9.1f}ms {level['events_per_sec']:>11,.0f}"
+            )
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await task
+
+if __name__ == "__main__":
+    asyncio.run(main())
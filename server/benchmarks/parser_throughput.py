@@ -0,0 +1,54 @@
+"""Parser throughput in lines/sec across markdown mixes and parser modes.
+
+Run from the server directory:
+    python -m benchmarks.parser_throughput [--repeat 200] [--chunk-chars 4]
+"""
+import argparse
+import time
+
+from benchmarks.fakes import use_fake_backends
+
+use_fake_backends()
+
+import app
+
+PROSE = "A plain paragraph of prose with a **bold** word, a `code` span and a [link](https://example.com).\n"
+MIXES = {
+    "prose": PROSE * 20,
+    "headings": "".join(f"{'#' * (level % 6 + 1)} Heading {level}\n{PROSE}" for level in range(10)),
+    "lists": "".join(f"- bullet {index} with *emphasis*\n{index + 1}. numbered {index}\n" for index in range(10)),
+    "tables": "| Name | Value | Notes |\n|:---|---:|---|\n" + "".join(f"| row {index} | {index} | `x` |\n" for index in range(20)),
+    "code": "```python\n" + "".join(f"def f{index}(x):\n    return x * {index}\n" for index in range(10)) + "```\n",
+    "mixed": app.FAKE_RESPONSE,
+}
+MODES = {
+    "default": {},
+    "incremental": {"incremental": True},
+    "grouped": {"incremental": True, "grouped": True},
+}
+
+def run(document: str, chunk_chars: int, options: dict) -> int:
+    parser = app.EnhancedStreamingContentParser(**options)
+    events = 0
+    for start in range(0, len(document), chunk_chars):
+        events += len(parser.process_content_chunk(document[start:start + chunk_chars]))
+    return events + len(parser.finalize())
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arguments.add_argument("--repeat", type=int, default=200, help="copies of each mix per run")
+    arguments.add_argument("--chunk-chars", type=int, default=4, help="characters per streamed chunk")
+    options = arguments.parse_args()
+    
+    print(f"{'mix':<10} {'mode':<12} {'lines/sec':>12} {'events/sec':>12} {'MB/sec':>8}")
+    for mix, sample in MIXES.items():
+        document = sample * options.repeat
+        lines = document.count("\n")
+        for mode, parser_options in MODES.items():
+            started = time.perf_counter()
+            events = run(document, options.chunk_chars, parser_options)
+            seconds = time.perf_counter() - started
+            print(f"{mix:<10} {mode:<12} {lines / seconds:12,.0f} {events / seconds:12,.0f} {len(document) / seconds / 1e6:8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Cold start: module import time and background warm-up per phase.
+
+Each run imports app in a fresh interpreter, opens the lifespan and waits for warm-up,
+so results include SDK import costs. Providers use the configured settings; dummy API
+keys are set because nothing is called.
+
+Run from the server directory:
+    python -m benchmarks.startup [--runs 5] [--fake]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import asyncio, json, time
+started = time.perf_counter()
+import app
+
+async def main():
+    async with app.lifespan(app.app):
+        await app.warmup_task
+    return time.perf_counter() - started
+
+total = asyncio.run(main())
+print(json.dumps({**app.startup_timings, "import_to_ready": total}))
+"""
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arguments.add_argument("--runs", type=int, default=5)
+    arguments.add_argument("--fake", action="store_true", help="use the fake model and search backends")
+    options = arguments.parse_args()
+    
+    env = {"GROQ_API_KEY": "benchmark", "TAVILY_API_KEY": "benchmark", "GOOGLE_API_KEY": "benchmark", **os.environ}
+    if options.fake:
+        env.update(FAST_MODEL="fake:fast", STRONG_MODEL="fake:strong", SEARCH_BACKEND="fake")
+    
+    runs = []
+    for _ in range(options.runs):
+        output = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    
+    print(f"{'phase':<24} {'median':>9} {'max':>9}")
+    for phase in runs[0]:
+        values = [run[phase] for run in runs]
+        print(f"{phase:<24} {statistics.median(values) * 1000:7.1f}ms {max(values) * 1000:7.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Memory growth per conversation thread, measured with tracemalloc.
+
+Runs --threads conversations of --turns turns each through the graph with the fake
+backends and reports Python heap growth per thread, plus the checkpointer's own
+accounting when it keeps one.
+
+Run from the server directory:
+    python -m benchmarks.thread_memory [--threads 200] [--turns 3] [--checkpointer lru]
+"""
+import argparse
+import asyncio
+import gc
+import tracemalloc
+
+from benchmarks.fakes import use_fake_backends
+
+async def run(threads: int, turns: int, prompt: str):
+    import app
+    from langchain_core.messages import HumanMessage
+    
+    async with app.lifespan(app.app):
+        # Warm up imports and caches so they are not counted as per-thread growth
+        await app.get_graph().ainvoke({"messages": [HumanMessage(content=prompt)]}, {"configurable": {"thread_id": "warmup"}})
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        
+        for thread in range(threads):
+            config = {"configurable": {"thread_id": f"thread-{thread}"}}
+            for turn in range(turns):
+                await app.get_graph().ainvoke({"messages": [HumanMessage(content=f"{prompt} ({turn})")]}, config)
+        
+        gc.collect()
+        grown = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        
+        print(f"checkpointer: {type(app.memory).__name__}, {threads} threads x {turns} turns")
+        print(f"  heap growth: {grown / 1024 / 1024:.2f} MiB, {grown / threads / 1024:.1f} KiB per thread")
+        if isinstance(app.memory, app.BoundedMemorySaver):
+            kept = len(app.memory._last_access)
+            print(f"  checkpointer accounting: {app.memory.total_bytes / 1024 / 1024:.2f} MiB across {kept} retained threads")
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arguments.add_argument("--threads", type=int, default=200)
+    arguments.add_argument("--turns", type=int, default=3)
+    arguments.add_argument("--checkpointer", choices=["memory", "lru"], default="lru")
+    arguments.add_argument("--max-threads", type=int, default=1000, help="CHECKPOINTER_MAX_THREADS for the lru backend")
+    arguments.add_argument("--prompt", default="Write a short project brief")
+    options = arguments.parse_args()
+    
+    use_fake_backends(CHECKPOINTER=options.checkpointer, CHECKPOINTER_MAX_THREADS=str(options.max_threads))
+    asyncio.run(run(options.threads, options.turns, options.prompt))
+
+if __name__ == "__main__":
+    main()
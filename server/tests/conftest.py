@@ -0,0 +1,14 @@
+"""Tests run the app against the local fake model and search backends.
+
+Settings are read when app is imported, so the fakes are configured here first.
+Run from the server directory:
+    python -m pytest -q
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import use_fake_backends
+
+use_fake_backends()
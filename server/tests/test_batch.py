@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+import httpx
+
+import app
+
+JOBS = [{"message": "Write a short project brief", "id": "brief"}, {"message": "Tell me a story"}]
+
+async def post_batch(body: dict, params: dict = None) -> httpx.Response:
+    async with app.lifespan(app.app):
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/batch", json=body, params=params)
+
+def test_ndjson_has_one_line_per_job():
+    response = asyncio.run(post_batch({"jobs": JOBS}, {"stream": "false"}))
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["job_id"] for line in lines) == ["1", "brief"]
+    for line in lines:
+        assert line["ok"] and line["checkpoint_id"]
+        types = [event["type"] for event in line["events"]]
+        assert types[0] == "checkpoint" and types[-1] == "end" and "content" in types
+        assert line["events"][0]["checkpoint_id"] == line["checkpoint_id"]
+
+def test_stream_tags_every_event_with_its_job():
+    response = asyncio.run(post_batch({"jobs": JOBS}, {"format": "compact"}))
+
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert [event["type"] for event in events[-2:]] == ["batch_end", "end"]
+    assert events[-2]["jobs"] == 2
+    jobs = events[:-2]
+    assert all(event["job_id"] in ("brief", "1") for event in jobs)
+    assert sorted(event["job_id"] for event in jobs if event["type"] == "job_end") == ["1", "brief"]
+    for job_id in ("brief", "1"):
+        own = [event["type"] for event in jobs if event["job_id"] == job_id]
+        assert own[0] == "schema" and own[-2:] == ["end", "job_end"]
+
+def test_duplicate_job_ids_are_rejected():
+    response = asyncio.run(post_batch({"jobs": [{"message": "a", "id": "x"}, {"message": "b", "id": "x"}]}))
+    assert response.status_code == 422
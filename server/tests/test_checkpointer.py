@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+from langchain_core.messages import HumanMessage
+
+import app
+
+def run_turns(saver: app.BoundedMemorySaver, thread_ids: list):
+    graph = app.graph_builder.compile(checkpointer=saver)
+
+    async def turns():
+        for thread_id in thread_ids:
+            await graph.ainvoke({"messages": [HumanMessage(content="Write a short project brief")]}, {"configurable": {"thread_id": thread_id}})
+    asyncio.run(turns())
+
+def state(saver: app.BoundedMemorySaver, thread_id: str):
+    return saver.get_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}})
+
+def test_evicts_least_recently_used_threads():
+    saver = app.BoundedMemorySaver(max_threads=2)
+    run_turns(saver, ["a", "b"])
+    # Reading "a" makes "b" the least recently used
+    assert state(saver, "a") is not None
+    run_turns(saver, ["c"])
+
+    assert list(saver._last_access) == ["a", "c"]
+    assert state(saver, "b") is None
+    assert "b" not in saver.storage
+    assert saver.total_bytes == sum(saver._thread_bytes.values())
+
+def test_byte_budget_keeps_only_the_thread_being_written():
+    saver = app.BoundedMemorySaver(max_bytes=1)
+    run_turns(saver, ["a", "b"])
+
+    assert list(saver._last_access) == ["b"]
+    assert saver.total_bytes == saver._thread_bytes["b"] > 1
+
+def test_idle_threads_expire():
+    saver = app.BoundedMemorySaver(ttl_seconds=0.05)
+    run_turns(saver, ["a"])
+    time.sleep(0.1)
+
+    assert state(saver, "a") is None
+    assert saver.total_bytes == 0
+    assert not saver.blobs and not saver.writes
+
+def test_unknown_threads_leave_no_storage():
+    saver = app.BoundedMemorySaver()
+    for index in range(50):
+        assert state(saver, f"missing-{index}") is None
+        assert list(saver.list({"configurable": {"thread_id": f"missing-{index}"}})) == []
+
+    assert not saver.storage
@@ -0,0 +1,69 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, SystemMessage
+
+import app
+
+def turns(count: int) -> list:
+    messages = []
+    for index in range(count):
+        messages += [HumanMessage(content=f"question {index} " * 20, id=f"h{index}"), AIMessage(content=f"answer {index} " * 20, id=f"a{index}")]
+    return messages
+
+def test_dropped_turns_are_folded_into_the_summary(monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_SUMMARIZE", True)
+    monkeypatch.setattr(app, "HISTORY_MAX_TOKENS", 400)
+
+    async def scenario():
+        await app.get_model_routes.abuild()
+        # "Current summary" in the summary prompt must not turn into a fake search
+        return await app.assemble_prompt({"messages": turns(4) + [HumanMessage(content="latest", id="h4")], "summary": ""})
+
+    prompt, updates = asyncio.run(scenario())
+    assert updates["summary"] == app.FAKE_RESPONSE
+    removed = [message.id for message in updates["messages"] if isinstance(message, RemoveMessage)]
+    kept = [message.id for message in prompt[1:]]
+    assert removed and not set(removed) & set(kept)
+    assert app.FAKE_RESPONSE in prompt[0].content
+
+def test_empty_summary_keeps_the_dropped_turns(monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_SUMMARIZE", True)
+    monkeypatch.setattr(app, "HISTORY_MAX_TOKENS", 400)
+
+    async def empty_summary(summary, messages):
+        return ""
+    monkeypatch.setattr(app, "summarize_history", empty_summary)
+
+    prompt, updates = asyncio.run(app.assemble_prompt({"messages": turns(4) + [HumanMessage(content="next", id="h4")], "summary": "earlier"}))
+    assert updates["messages"] == []
+    assert "summary" not in updates
+    assert isinstance(prompt[0], SystemMessage) and "earlier" in prompt[0].content
+    assert prompt[-1].id == "h4"
+
+def test_history_is_trimmed_to_the_budget_from_a_human_turn(monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_MAX_TOKENS", 400)
+    history = turns(4) + [HumanMessage(content="next", id="h4")]
+
+    prompt, updates = asyncio.run(app.assemble_prompt({"messages": history}))
+    assert prompt[0] is app.SYSTEM_MESSAGE
+    kept = prompt[1:]
+    assert kept == history[-len(kept):] and len(kept) < len(history)
+    assert isinstance(kept[0], HumanMessage)
+    assert app.count_tokens_approximately(prompt) <= 400
+    # Without HISTORY_SUMMARIZE older turns stay in state
+    assert updates == {"messages": []}
+
+def test_oversized_turn_is_sent_whole(monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_MAX_TOKENS", 50)
+    history = turns(2) + [HumanMessage(content="long request " * 100, id="h2")]
+
+    prompt, _ = asyncio.run(app.assemble_prompt({"messages": history}))
+    assert prompt[1:] == history[-1:]
+
+def test_legacy_system_messages_are_removed():
+    history = [SystemMessage(content="old prompt", id="s0"), *turns(1), SystemMessage(content="old prompt", id="s1"), HumanMessage(content="next", id="h1")]
+
+    prompt, updates = asyncio.run(app.assemble_prompt({"messages": history}))
+    assert [message for message in prompt if isinstance(message, SystemMessage)] == [app.SYSTEM_MESSAGE]
+    assert [message.id for message in updates["messages"]] == ["s0", "s1"]
+    assert all(isinstance(message, RemoveMessage) for message in updates["messages"])
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import app
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_slots_are_handed_over_in_arrival_order():
+    async def scenario():
+        limiter = app.ConcurrencyLimiter("test", limit=1, max_waiting=10)
+        order = []
+        release = asyncio.Event()
+
+        async def use(name):
+            async with limiter.slot():
+                order.append(name)
+                await release.wait()
+
+        first = asyncio.ensure_future(use("first"))
+        await settle()
+        waiters = [asyncio.ensure_future(use(name)) for name in ("second", "third")]
+        await settle()
+        assert (limiter.active, limiter.waiting) == (1, 2)
+
+        release.set()
+        # A late arrival queues behind the waiters instead of taking the freed slot
+        late = asyncio.ensure_future(use("late"))
+        await asyncio.gather(first, *waiters, late)
+        return order, limiter
+
+    order, limiter = asyncio.run(scenario())
+    assert order == ["first", "second", "third", "late"]
+    assert (limiter.active, limiter.waiting) == (0, 0)
+
+def test_waiters_are_told_their_queue_position(monkeypatch):
+    monkeypatch.setattr(app, "QUEUE_POSITION_INTERVAL_SECONDS", 0.01)
+
+    async def scenario():
+        limiter = app.ConcurrencyLimiter("test", limit=1, max_waiting=10)
+        positions = []
+        releases = [asyncio.Event() for _ in range(3)]
+
+        async def hold(release, on_wait=None):
+            async with limiter.slot(on_wait):
+                await release.wait()
+
+        async def report(position):
+            positions.append(position)
+
+        holders = [asyncio.ensure_future(hold(release)) for release in releases[:2]]
+        await settle()
+        waiter = asyncio.ensure_future(hold(releases[2], report))
+        await settle()
+        for release in releases:
+            release.set()
+            await asyncio.sleep(0.05)
+        await asyncio.gather(*holders, waiter)
+        return positions
+
+    assert asyncio.run(scenario()) == [2, 1]
+
+def test_full_queue_is_rejected():
+    async def scenario():
+        limiter = app.ConcurrencyLimiter("test", limit=1, max_waiting=1)
+        await limiter._acquire(None)
+        waiter = asyncio.ensure_future(limiter._acquire(None))
+        await settle()
+        assert limiter.is_full
+        with pytest.raises(app.QueueFullError):
+            await limiter._acquire(None)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        limiter = app.ConcurrencyLimiter("test", limit=1, max_waiting=10)
+        await limiter._acquire(None)
+        cancelled = asyncio.ensure_future(limiter._acquire(None))
+        waiting = asyncio.ensure_future(limiter._acquire(None))
+        await settle()
+
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert (limiter.active, limiter.waiting) == (1, 1)
+
+        limiter._release()
+        await waiting
+        limiter._release()
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert (limiter.active, limiter.waiting) == (0, 0)
+
+def test_slot_handed_to_a_cancelled_waiter_is_passed_on():
+    async def scenario():
+        limiter = app.ConcurrencyLimiter("test", limit=1, max_waiting=10)
+        await limiter._acquire(None)
+        cancelled = asyncio.ensure_future(limiter._acquire(None))
+        waiting = asyncio.ensure_future(limiter._acquire(None))
+        await settle()
+
+        # Hand the slot over and cancel its new owner before it gets to run
+        limiter._release()
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        await asyncio.wait_for(waiting, timeout=1)
+        assert (limiter.active, limiter.waiting) == (1, 0)
+        limiter._release()
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert (limiter.active, limiter.waiting) == (0, 0)
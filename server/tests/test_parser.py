@@ -0,0 +1,152 @@
+import asyncio
+import json
+from urllib.parse import quote
+
+import httpx
+import pytest
+
+import app
+
+DOCUMENT = (
+    "# Title\n"
+    "Some **bold** text.\n"
+    "\n"
+    "| A | B |\n"
+    "|---|---|\n"
+    "| 1 | 2 |\n"
+    "\n"
+    "- one\n"
+    "- two\n"
+    "\n"
+    "```python\n"
+    "x = 1\n"
+    "```\n"
+    "Done.\n"
+)
+
+def parse(document: str, chunk_chars: int = 3, **options) -> list:
+    parser = app.EnhancedStreamingContentParser(**options)
+    events = []
+    for start in range(0, len(document), chunk_chars):
+        events += parser.process_content_chunk(document[start:start + chunk_chars])
+    return [app.event_dict(event) for event in events + parser.finalize()]
+
+def block_types(events: list) -> list:
+    return [event["block_info"]["type"] for event in events if event["type"] == "block_start"]
+
+def of_type(events: list, event_type: str) -> list:
+    return [event for event in events if event["type"] == event_type]
+
+def test_default_mode_sends_whole_lines():
+    events = parse(DOCUMENT)
+
+    assert block_types(events) == [
+        "heading_1", "paragraph", "table", "table", "table",
+        "bulleted_list_item", "bulleted_list_item", "code_block", "paragraph",
+    ]
+    assert not of_type(events, "content_delta")
+    assert [event["content"] for event in of_type(events, "content")][:2] == ["# Title", "Some **bold** text."]
+    assert not any(event.get("streamed") for event in of_type(events, "content"))
+    assert events[-1]["type"] == "end"
+    assert events[-1]["summary"]["had_tables"] and events[-1]["summary"]["had_code_blocks"]
+
+@pytest.mark.parametrize("chunk_chars", [1, 3, 7, len(DOCUMENT)])
+def test_output_does_not_depend_on_chunking(chunk_chars):
+    assert block_types(parse(DOCUMENT, chunk_chars)) == block_types(parse(DOCUMENT, 1))
+
+def test_incremental_mode_streams_partial_lines():
+    events = parse(DOCUMENT, incremental=True)
+
+    # Same blocks as whole-line parsing, opened before their line is complete
+    assert block_types(events) == block_types(parse(DOCUMENT))
+    paragraph = next(event for event in events if event["type"] == "block_start" and event["block_info"]["type"] == "paragraph")
+    assert "content" not in paragraph["block_info"]
+    assert "text" not in paragraph["block_info"]["metadata"]
+
+    block_id = paragraph["block_info"]["block_id"]
+    deltas = "".join(event["content"] for event in of_type(events, "content_delta") if event["block_id"] == block_id)
+    assert "Some **bold** text.".startswith(deltas) and deltas
+    line = next(event for event in of_type(events, "content") if event["content"] == "Some **bold** text.")
+    assert line["streamed"]
+
+@pytest.mark.parametrize("line", ["---  ", "***", "1. ", "> ", "## "])
+def test_incremental_mode_waits_for_unsettled_prefixes(line):
+    parser = app.EnhancedStreamingContentParser(incremental=True)
+    assert parser.process_content_chunk(line) == []
+
+def test_grouped_mode_folds_tables_lists_and_code():
+    events = parse(DOCUMENT, incremental=True, grouped=True)
+
+    assert block_types(events) == ["heading_1", "paragraph", "table_group", "list_group", "code_block", "paragraph"]
+    table = next(event for event in events if event["type"] == "block_start" and event["block_info"]["type"] == "table_group")
+    assert table["block_info"]["metadata"]["headers"] == ["A", "B"]
+
+    appends = [(event["op"], event["value"]) for event in of_type(events, "block_append")]
+    # The alignment row is dropped
+    assert appends == [("row", ["1", "2"]), ("item", {"content": "one"}), ("item", {"content": "two"}), ("line", "x = 1")]
+    code_end = next(event for event in of_type(events, "block_end") if "content" in event)
+    assert code_end["content"] == "x = 1"
+
+@pytest.mark.parametrize("document", [DOCUMENT, app.FAKE_RESPONSE])
+@pytest.mark.parametrize("options", [{"grouped": True}, {"incremental": True}, {"incremental": True, "grouped": True}])
+def test_end_summary_is_the_same_in_every_mode(document, options):
+    # Grouped lines become block_append events but still count towards the summary
+    assert parse(document, **options)[-1]["summary"] == parse(document)[-1]["summary"]
+
+def test_compact_events_drop_duplicates_and_keep_group_headers():
+    events = parse(DOCUMENT, grouped=True)
+    compact = [app.compact_event(event) for event in events]
+
+    heading = next(event for event in compact if event["type"] == "block_start")
+    assert heading["block_info"]["metadata"] == {"level": 1}
+    table = next(event for event in compact if event["type"] == "block_start" and event["block_info"]["type"] == "table_group")
+    assert table["block_info"]["metadata"]["headers"] == ["A", "B"]
+
+    bold = next(event for event in compact if event["type"] == "content" and "bold" in event["content"])
+    assert bold["flags"] & 1 << app.COMPACT_FLAGS.index("has_bold")
+    assert "metadata" not in bold
+
+    rows = [app.compact_event(event) for event in parse(DOCUMENT) if event["type"] == "block_start"]
+    row = next(event for event in rows if event["block_info"].get("subtype") == "row")
+    assert "headers" not in row["block_info"].get("metadata", {})
+
+async def stream_events(path: str, params: dict) -> list:
+    async with app.lifespan(app.app):
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.get(path, params=params)
+    assert response.status_code == 200
+    return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+@pytest.mark.parametrize("params", [
+    {},
+    {"incremental": "true"},
+    {"incremental": "true", "grouped": "true"},
+    {"format": "compact"},
+])
+def test_enhanced_stream_with_fake_model(params):
+    events = asyncio.run(stream_events(f"/enhanced_chat_stream/{quote('Write a short project brief')}", params))
+
+    types = [event["type"] for event in events]
+    assert types[0] == ("schema" if params.get("format") == "compact" else "checkpoint")
+    assert types[-1] == "end"
+    assert "block_start" in types and "content" in types
+    assert ("content_delta" in types) == ("incremental" in params)
+    assert ("block_append" in types) == ("grouped" in params)
+
+def test_stored_blocks_leave_out_content_deltas():
+    async def scenario():
+        async with app.lifespan(app.app):
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                response = await client.get(f"/enhanced_chat_stream/{quote('Write a short project brief')}", params={"incremental": "true"})
+                thread_id = json.loads(response.text.split("data: ", 2)[1].split("\n", 1)[0])["checkpoint_id"]
+                stored = await client.get(f"/thread/{thread_id}/blocks", params={"stream": "false"})
+        return response, stored.json()
+
+    response, stored = asyncio.run(scenario())
+    streamed = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert of_type(streamed, "content_delta")
+    assert not of_type(stored["events"], "content_delta")
+    # Each line's text is still stored in full
+    assert of_type(stored["events"], "content") == of_type(streamed, "content")
@@ -0,0 +1,42 @@
+import asyncio
+import json
+from urllib.parse import quote
+
+import httpx
+
+import app
+
+def content_events(text: str) -> list:
+    events = [json.loads(line[len("data: "):]) for line in text.splitlines() if line.startswith("data: ")]
+    return [event for event in events if event["type"] in ("content", "block_start", "block_end")]
+
+def test_cached_answers_replay_through_the_block_pipeline(monkeypatch):
+    monkeypatch.setattr(app, "response_cache", app.TTLCache(100, 600))
+
+    async def scenario():
+        routes = await app.get_model_routes.abuild()
+        calls = {name: route.calls for name, route in routes.items()}
+        hits = {name: route.cache_hits for name, route in routes.items()}
+        async with app.lifespan(app.app):
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                path = f"/enhanced_chat_stream/{quote('Tell me a story')}"
+                live = await client.get(path)
+                cached = await client.get(path)
+        return live.text, cached.text, {name: route.calls - calls[name] for name, route in routes.items()}, {name: route.cache_hits - hits[name] for name, route in routes.items()}
+
+    live, cached, calls, hits = asyncio.run(scenario())
+    assert sum(calls.values()) == 1
+    assert sum(hits.values()) == 1
+    strip_ids = lambda events: [{key: value for key, value in event.items() if key not in ("block_id", "block_info")} for event in events]
+    assert strip_ids(content_events(cached)) == strip_ids(content_events(live))
+    assert '"type":"end"' in cached.replace(" ", "")
+
+def test_cache_key_is_exact_on_prompt_text():
+    from langchain_core.messages import HumanMessage
+
+    key = lambda text: app.response_cache_key([app.SYSTEM_MESSAGE, HumanMessage(content=text)], "fake:fast")
+    assert key("Hello") == key("  Hello\n")
+    assert key("Hello") != key("hello")
+    assert key("a  b") != key("a b")
+    assert key("Hello") != app.response_cache_key([app.SYSTEM_MESSAGE, HumanMessage(content="Hello")], "fake:strong")
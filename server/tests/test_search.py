@@ -0,0 +1,138 @@
+import asyncio
+import json
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableLambda
+
+import app
+
+def result(url: str, score: float, content: str = "Some page text.") -> dict:
+    return {"url": url, "title": "Title", "content": content, "score": score}
+
+def test_compact_keeps_the_best_result_and_drops_low_scores():
+    compacted = app.compact_search_result({"results": [
+        result("https://a.example/1", 0.9),
+        result("https://b.example/1", 0.1),
+        result("https://c.example/1", 0.5),
+    ]}, "query", 1000, set())
+    assert [item["url"] for item in compacted["results"]] == ["https://a.example/1", "https://c.example/1"]
+
+    # A lone low-scoring result is still better than nothing
+    compacted = app.compact_search_result({"results": [result("https://a.example/1", 0.1)]}, "query", 1000, set())
+    assert len(compacted["results"]) == 1
+
+def test_compact_skips_domains_already_seen(monkeypatch):
+    seen = {"a.example"}
+    compacted = app.compact_search_result({"results": [
+        result("https://www.a.example/other", 0.9),
+        result("https://b.example/1", 0.8),
+        result("https://b.example/2", 0.7),
+    ]}, "query", 1000, seen)
+    assert [item["url"] for item in compacted["results"]] == ["https://b.example/1"]
+    assert seen == {"a.example", "b.example"}
+
+    monkeypatch.setattr(app, "SEARCH_DEDUP_DOMAINS", False)
+    seen = {"https://b.example/1"}
+    compacted = app.compact_search_result({"results": [
+        result("HTTPS://B.example/1/", 0.9),
+        result("https://b.example/2", 0.8),
+    ]}, "query", 1000, seen)
+    assert [item["url"] for item in compacted["results"]] == ["https://b.example/2"]
+
+def test_compact_stops_at_the_token_budget_and_trims_content():
+    page = "Unrelated filler sentence. " * 40 + "The query term appears here."
+    compacted = app.compact_search_result({"answer": "Short answer", "results": [
+        result("https://a.example/1", 0.9, page),
+        result("https://b.example/1", 0.8, page),
+    ]}, "query term", 20, set())
+
+    assert compacted["answer"] == "Short answer"
+    assert len(compacted["results"]) == 1
+    assert compacted["results"][0]["content"] == "The query term appears here."
+
+def test_compact_passes_errors_through():
+    compacted = app.compact_search_result({"error": ValueError("boom")}, "query", 1000, set())
+    assert compacted == {"query": "query", "error": "boom", "results": []}
+
+def search_call(call_id: str, query: str, **args) -> dict:
+    return {"name": app.SEARCH_TOOL_NAME, "args": {"query": query, **args}, "id": call_id}
+
+def count_searches(monkeypatch) -> list:
+    queries = []
+    search = app.FakeTavilySearch._search
+
+    async def counted(self, query, run_manager=None, **kwargs):
+        queries.append(query)
+        return await search(self, query, run_manager=run_manager, **kwargs)
+    monkeypatch.setattr(app.FakeTavilySearch, "_search", counted)
+    return queries
+
+def run_tool_node(calls: list, thread_id: str = "thread") -> tuple:
+    events = []
+
+    async def scenario():
+        node = RunnableLambda(app.tool_node)
+        state = {"messages": [AIMessage(content="", tool_calls=calls)]}
+        async for event in node.astream_events(state, {"configurable": {"thread_id": thread_id}}, version="v2"):
+            if event["event"] == "on_custom_event":
+                events.append(event["data"])
+            elif event["event"] == "on_chain_end" and event["name"] == "tool_node":
+                output = event["data"]["output"]
+        return output["messages"], events
+    return asyncio.run(scenario())
+
+def test_tool_node_searches_each_query_once(monkeypatch):
+    queries = count_searches(monkeypatch)
+    messages, events = run_tool_node([
+        search_call("1", "Latest Python release"),
+        search_call("2", "  latest python   RELEASE "),
+        search_call("3", "rust news"),
+    ])
+
+    assert sorted(queries) == ["Latest Python release", "rust news"]
+    assert [message.tool_call_id for message in messages] == ["1", "2", "3"]
+    assert messages[1].content == "Duplicate of search call 1; see its results."
+    assert len(events) == 2
+
+    # Fake results for every query come from the same domains: each is kept only once
+    urls = [item["url"] for message in (messages[0], messages[2]) for item in json.loads(message.content)["results"]]
+    domains = [app.url_domain(url) for url in urls]
+    assert urls and len(domains) == len(set(domains))
+
+def test_tool_node_reports_timed_out_searches(monkeypatch):
+    monkeypatch.setattr(app, "SEARCH_TIMEOUT_SECONDS", 0.05)
+    monkeypatch.setattr(app, "FAKE_SEARCH_LATENCY_MS", 1000)
+    messages, events = run_tool_node([search_call("1", "slow query")])
+
+    assert isinstance(messages[0], ToolMessage) and messages[0].status == "error"
+    assert "timed out" in json.loads(messages[0].content)["error"]
+    assert "timed out" in events[0]["error"]
+
+def test_prefetch_is_claimed_only_by_a_matching_search():
+    task = object()
+    app.search_prefetches["thread"] = ("latest python release", task)
+    try:
+        assert app.claim_search_prefetch("thread", {"query": "rust borrow checker"}) is None
+        assert app.claim_search_prefetch("thread", {"query": "latest python release", "topic": "news"}) is None
+        assert app.claim_search_prefetch("other", {"query": "latest python release"}) is None
+        assert "thread" in app.search_prefetches
+
+        claimed = app.claim_search_prefetch("thread", {"query": "python latest release notes", "topic": "general", "include_images": False})
+        assert claimed is task
+        assert "thread" not in app.search_prefetches
+    finally:
+        app.search_prefetches.pop("thread", None)
+
+def test_prefetched_search_is_reused_by_the_tool_node(monkeypatch):
+    monkeypatch.setattr(app, "SEARCH_PREFETCH", True)
+    queries = count_searches(monkeypatch)
+
+    async def scenario():
+        graph = app.graph_builder.compile(checkpointer=app.BoundedMemorySaver())
+        await app.get_model_routes.abuild()
+        return await graph.ainvoke({"messages": [HumanMessage(content="latest python release")]}, {"configurable": {"thread_id": "prefetch"}})
+
+    state = asyncio.run(scenario())
+    assert queries == ["latest python release"]
+    assert any(isinstance(message, ToolMessage) and message.status == "success" for message in state["messages"])
+    assert "prefetch" not in app.search_prefetches
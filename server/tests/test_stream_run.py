@@ -0,0 +1,120 @@
+import asyncio
+import json
+from urllib.parse import quote
+
+import httpx
+
+import app
+
+async def numbered_frames(count: int):
+    for index in range(1, count + 1):
+        yield app.sse_event({"type": "content", "content": str(index)})
+
+async def collect(frames) -> list:
+    return [frame async for frame in frames]
+
+def seqs(frames: list) -> list:
+    return [int(frame.split("\n", 1)[0].rpartition("-")[2]) for frame in frames if frame.startswith("id: ")]
+
+def payloads(frames: list) -> list:
+    return [json.loads(frame.rpartition("data: ")[2]) for frame in frames]
+
+def test_follow_numbers_frames_and_resumes_after_last_event_id():
+    async def scenario():
+        run = app.StreamRun("run", numbered_frames(5))
+        first = await collect(run.follow())
+        resumed = await collect(run.follow(after=3))
+        finished = await collect(run.follow(after=5))
+        return first, resumed, finished
+
+    first, resumed, finished = asyncio.run(scenario())
+    assert seqs(first) == [1, 2, 3, 4, 5]
+    assert first[0].startswith("id: run-1\n")
+    assert seqs(resumed) == [4, 5]
+    # Nothing left to replay: the client is told the stream is over
+    assert finished == [app.END_FRAME]
+
+def test_resume_past_the_ring_buffer_is_gone():
+    async def scenario():
+        run = app.StreamRun("run", numbered_frames(5), max_events=2)
+        await run.task
+        return await collect(run.follow(after=1))
+
+    assert [event["type"] for event in payloads(asyncio.run(scenario()))] == ["error", "end"]
+
+def test_generation_errors_end_the_stream_for_every_follower():
+    async def failing():
+        yield app.sse_event({"type": "content", "content": "partial"})
+        raise RuntimeError("model failed")
+
+    async def scenario():
+        run = app.StreamRun("run", failing())
+        live = await collect(run.follow())
+        resumed = await collect(run.follow(after=1))
+        return live, resumed
+
+    live, resumed = asyncio.run(scenario())
+    assert [event["type"] for event in payloads(live)] == ["content", "error", "end"]
+    assert payloads(live)[1]["status"] == 500
+    assert [event["type"] for event in payloads(resumed)] == ["error", "end"]
+
+def test_cancel_stops_the_generation():
+    closed = asyncio.Event()
+
+    async def endless():
+        try:
+            yield app.sse_event({"type": "content", "content": "first"})
+            await asyncio.Event().wait()
+        finally:
+            closed.set()
+
+    async def scenario():
+        run = app.StreamRun("run", endless())
+        follower = run.follow()
+        await follower.__anext__()
+        run.cancel()
+        rest = await collect(follower)
+        return run, rest
+
+    run, rest = asyncio.run(scenario())
+    assert run.done
+    assert rest == []
+    assert closed.is_set()
+
+def test_last_follower_disconnecting_cancels_after_the_grace_period(monkeypatch):
+    monkeypatch.setattr(app, "STREAM_DISCONNECT_GRACE_SECONDS", 0.05)
+
+    async def endless():
+        while True:
+            yield app.sse_event({"type": "content", "content": "tick"})
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        run = app.StreamRun("run", endless())
+        follower = run.follow()
+        await follower.__anext__()
+        await follower.aclose()
+        assert run.followers == 0 and not run.done
+        await asyncio.wait_for(run.task, timeout=1)
+        return run
+
+    assert asyncio.run(scenario()).done
+
+def test_reconnect_with_last_event_id():
+    async def scenario():
+        async with app.lifespan(app.app):
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                path = f"/enhanced_chat_stream/{quote('Write a short project brief')}"
+                first = await client.get(path)
+                ids = [line[len("id: "):] for line in first.text.splitlines() if line.startswith("id: ")]
+                resumed = await client.get(path, headers={"Last-Event-ID": ids[-3]})
+                unknown = await client.get(path, headers={"Last-Event-ID": "unknown-1"})
+        return ids, resumed, unknown
+
+    ids, resumed, unknown = asyncio.run(scenario())
+    resumed_ids = [line[len("id: "):] for line in resumed.text.splitlines() if line.startswith("id: ")]
+    assert resumed_ids == ids[-2:]
+    unknown_events = [json.loads(line[len("data: "):]) for line in unknown.text.splitlines() if line.startswith("data: ")]
+    assert [event["type"] for event in unknown_events] == ["error", "end"]
+    assert unknown_events[0]["status"] == 410
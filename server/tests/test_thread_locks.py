@@ -0,0 +1,61 @@
+import asyncio
+import multiprocessing
+import os
+
+import pytest
+
+import app
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="cross-worker locks need lockf()")
+
+def hold_in_worker(lock_dir: str, thread_id: str, held, release):
+    async def hold():
+        async with app.ThreadLocks(lock_dir).hold(thread_id):
+            held.set()
+            while not release.is_set():
+                await asyncio.sleep(0.01)
+    asyncio.run(hold())
+
+def test_turns_on_one_thread_exclude_each_other_across_workers(tmp_path):
+    context = multiprocessing.get_context("fork")
+    held, release = context.Event(), context.Event()
+    worker = context.Process(target=hold_in_worker, args=(str(tmp_path), "busy", held, release))
+    worker.start()
+    try:
+        assert held.wait(5)
+        locks = app.ThreadLocks(str(tmp_path))
+
+        async def scenario():
+            with pytest.raises(app.ThreadBusyError):
+                async with locks.hold("busy", timeout=0.2):
+                    pass
+            # Other threads are unaffected
+            async with locks.hold("idle", timeout=0.2):
+                pass
+            release.set()
+            async with locks.hold("busy", timeout=5):
+                pass
+        asyncio.run(scenario())
+    finally:
+        release.set()
+        worker.join(5)
+
+    # One shared lock file, however many threads were locked
+    assert os.listdir(tmp_path) == ["threads.lock"]
+    assert not locks._held and not locks._locks
+
+def test_turns_on_one_thread_run_one_at_a_time(tmp_path):
+    locks = app.ThreadLocks(str(tmp_path))
+    order = []
+
+    async def turn(name: str):
+        async with locks.hold("thread"):
+            order.append(name)
+            await asyncio.sleep(0.02)
+            order.append(f"{name} done")
+
+    async def scenario():
+        await asyncio.gather(turn("first"), turn("second"))
+    asyncio.run(scenario())
+    assert order == ["first", "first done", "second", "second done"]
+    assert not locks._held and not locks._locks
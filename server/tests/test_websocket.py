@@ -0,0 +1,61 @@
+import json
+
+from fastapi.testclient import TestClient
+
+import app
+
+def receive_until_end(ws, stream_id: str) -> list:
+    events = []
+    while True:
+        event = ws.receive_json()
+        if event.get("stream_id") == stream_id:
+            events.append(event)
+            if event["type"] == "end":
+                return events
+
+def test_malformed_messages_get_a_400_and_keep_the_connection():
+    with TestClient(app.app) as client, client.websocket_connect("/ws") as ws:
+        for send in (lambda: ws.send_bytes(b"\xff\x00"), lambda: ws.send_text("not json"), lambda: ws.send_json([1, 2])):
+            send()
+            assert ws.receive_json() == {"type": "error", "status": 400, "message": "Messages must be JSON objects"}
+
+        # JSON in a binary frame is a message like any other
+        ws.send_bytes(json.dumps({"type": "prompt", "stream_id": "s", "message": "Write a short project brief"}).encode())
+        events = receive_until_end(ws, "s")
+        assert events[-1]["type"] == "end"
+        assert any(event["type"] == "content" for event in events)
+
+def test_prompt_events_are_tagged_and_resumable():
+    with TestClient(app.app) as client, client.websocket_connect("/ws") as ws:
+        ws.send_json({"type": "prompt", "stream_id": "first", "message": "Write a short project brief", "grouped": True})
+        events = receive_until_end(ws, "first")
+        assert events[0]["type"] == "checkpoint"
+        assert any(event["type"] == "block_append" for event in events)
+        event_ids = [event["event_id"] for event in events]
+
+        ws.send_json({"type": "resume", "stream_id": "again", "last_event_id": event_ids[-3]})
+        resumed = receive_until_end(ws, "again")
+        assert [event["event_id"] for event in resumed] == event_ids[-2:]
+
+        ws.send_json({"type": "resume", "stream_id": "gone", "last_event_id": "unknown-1"})
+        assert [event["type"] for event in receive_until_end(ws, "gone")] == ["error", "end"]
+
+def test_streams_can_be_cancelled(monkeypatch):
+    for route in app.get_model_routes().values():
+        monkeypatch.setattr(route.llm_with_tools, "tokens_per_second", 200)
+
+    with TestClient(app.app) as client, client.websocket_connect("/ws") as ws:
+        ws.send_json({"type": "prompt", "stream_id": "slow", "message": "Write a short project brief"})
+        first = ws.receive_json()
+        assert first["stream_id"] == "slow"
+
+        ws.send_json({"type": "prompt", "stream_id": "slow", "message": "again"})
+        ws.send_json({"type": "cancel", "stream_id": "slow"})
+        events = receive_until_end(ws, "slow")
+        assert {"stream_id": "slow", "type": "error", "status": 409, "message": "stream_id is already in use on this connection"} in events
+        assert events[-1] == {"stream_id": "slow", "type": "end", "cancelled": True}
+        run = next(reversed(app.stream_runs.values()))
+        assert run.task.done() or run.task.cancelling()
+
+        ws.send_json({"type": "cancel", "stream_id": "slow"})
+        assert ws.receive_json() == {"type": "error", "status": 404, "message": "No active stream with this stream_id", "stream_id": "slow"}